@@ -18,46 +18,52 @@ import os.path
 import html
 import logging
 import time
+import multiprocessing
+import functools
 
 from types import SimpleNamespace
 
 import requests
 from ufal.udpipe import Model, Pipeline, ProcessingError
 
+import dump_reader
+import fulltexts
 
 
-def get_dir_name_fulltexts(title:str) -> str:
-	"""Little helper method. Returns name of a directory in which the article should be put
-	while sorting, based on the title of the article."""
-	
-	t_numeric = "numeric" #title begins with a number
-	t_alphaXX = "alpha_XX" # title has the same two letters at the beginning
-	t_others = "others"
-	t_alnum = "AlNum" # title begins with letter and number
-
-	if not title: # empty title
-		return t_others
-	elif title[0].isdigit(): # starts with a digit
-		return t_numeric
-	elif len(title) >= 2: # at least two character title
-		if title[0].isalpha() and title[1].isalpha() and title[0].upper() == title[1].upper():
-			return t_alphaXX
-		elif title[0].isalpha() and title[1].isalpha() and title[0].upper() != title[1].upper():
-			return title[0].upper() + title[1].upper()
-		elif title[0].isalpha() and title[1].isdigit():
-				return t_alnum
-		else:
-			return t_others
-	else:
-		return t_others
 
+def extract_pages_from_file(file_path:str, logger:logging.Logger = None) -> list:
+	"""Reads one file of the WikiExtractor HTML intermediary dump and returns list of extracted pages as tuples
+	(id, uri, title, first paragraph, full text, revision id). Disambiguation pages and the main page are left out.
+	Does not write anything, so it can be run in a worker process (see perform_extraction)."""
+
+	pages = []
+	for doc in dump_reader.read_docs(file_path, logger):
+		# Html text of wiki page (from <doc ...> to </doc>) is in doc.text. Now convert into plain text and extract info
+		page_title, page_uri, page_id, page_first_paragraph, page_fulltext = extract_page_info(doc.text)  
+
+		if ' (rozcestník)' in page_title or page_title.lower() == 'hlavní strana':
+			continue
+
+		page_title = re.sub(r' \([^\)]*\)$', '', page_title)
+
+		pages.append((page_id, page_uri, page_title, page_first_paragraph, page_fulltext, doc.revid))
+
+	return pages
 
-def perform_extraction(dumpdir:str, outputdir:str, logger:logging.Logger) -> None:
-	"""Entry point for performing extraction from WikiExtractor HTML intermediary dump"""
+
+def perform_extraction(dumpdir:str, outputdir:str, logger:logging.Logger, processes:int = 1, archive:bool = False) -> None:
+	"""Entry point for performing extraction from WikiExtractor HTML intermediary dump.
+	With 'processes' > 1 the files of the dump are converted in a pool of worker processes,
+	results are still written in the same order as in a serial run.
+	With 'archive' the full texts are packed into shard files with an index (see fulltexts.FulltextArchive)
+	instead of one file per article.
+	If the dump has revision ids (WikiExtractor.py --revision), they are written into revisions.txt (page id, revision id)
+	- get_images_for_knowledgebase.py uses them to find pages changed since its previous run."""
 
 	paragraphs_file_name = "paragraphs.txt"
 	fulltexts_dir_name = "fulltexts"
 	knowledgebase_file_name = "incomlete-kb.txt" # incomplete kb
+	revisions_file_name = "revisions.txt"
 	kb_file_name = "knowledgebase.txt" # complete
 
 
@@ -65,7 +71,12 @@ def perform_extraction(dumpdir:str, outputdir:str, logger:logging.Logger) -> Non
 	fulltexts_dir = os.path.join(outputdir, fulltexts_dir_name)
 	if not os.path.exists(fulltexts_dir):
 		os.makedirs(fulltexts_dir)
+	if archive:
+		fulltexts_writer = fulltexts.FulltextArchiveWriter(fulltexts_dir)
+	else:
+		fulltexts_writer = fulltexts.FulltextFiles(fulltexts_dir)
 	knowledgebase_file = open(os.path.join(outputdir, knowledgebase_file_name), "w")
+	revisions_file = None # created with the first revision id
 
 
 	logger.info("==== Performing extraction ====")
@@ -74,71 +85,53 @@ def perform_extraction(dumpdir:str, outputdir:str, logger:logging.Logger) -> Non
 	log_totalpagecount = 0
 	log_pagechunk = 10000 # display info after processing this many pages
 
+	file_paths = dump_reader.dump_files(dumpdir)
+	extract_pages = functools.partial(extract_pages_from_file, logger=logger)
+
+	# Converting HTML to text is CPU bound, so it is done file by file in worker processes. Writing stays here,
+	# Pool.imap() returns the results in the order of 'file_paths' (identical output to the serial run, 
+	# including which of the pages with the same title ends up in the fulltexts)
+	if processes > 1:
+		logger.info("Using {} extraction processes.".format(processes))
+		pool = multiprocessing.Pool(processes)
+		pages_per_file = pool.imap(extract_pages, file_paths)
+	else:
+		pool = None
+		pages_per_file = map(extract_pages, file_paths)
+
+	for pages in pages_per_file:
+		for page_id, page_uri, page_title, page_first_paragraph, page_fulltext, page_revid in pages:
+
+			# write data to specific files:
+			paragraphs_file.write(page_uri + '\t' + page_first_paragraph + '\n')
+
+			fulltexts_writer.write(page_title, page_fulltext)
+		
+			entity_line = "{}\t{}\t{}\t{}".format(page_id, page_uri, page_title, page_first_paragraph)
+			knowledgebase_file.write(entity_line + '\n')
 
-	### WARNING!: iterates over overy file in every subdirectory of 'dumpdir'! 
-	### Make sure no other subdirectories or files are in there
-	for subdir in [os.path.join(dumpdir,node) for node in os.listdir(dumpdir) if os.path.isdir(os.path.join(dumpdir, node))]:
-		for file_path in [os.path.join(subdir, node) for node in os.listdir(subdir) if os.path.isfile(os.path.join(subdir, node))]:
-			html_file = open(file_path, "r")
-			while True:
-				line = html_file.readline()
-				
-				# Found beginning of a wiki page
-				if line.strip().startswith('<doc'): # process page
-					doc_lines = []
-					doc_lines.append(line.strip())
-					
-					# Read all lines of wikipage ( <doc ...> * </doc> )
-					while True:
-						next_line = html_file.readline().strip()
-						if not next_line == '': # discard blank lines
-							doc_lines.append(next_line)
-						if next_line == "</doc>":
-							break
-					
-					# join by newline (which separates paragraphs in the html file) - 
-					# reading separate lines and then str.join() is faster than gradual concatenation)
-					doc_text = "\n".join(doc_lines)
-					# Html text of wiki page (from <doc ...> to </doc>) is in doc_text. Now convert into plain text and extract info
-					page_title, page_uri, page_id, page_first_paragraph, page_fulltext = extract_page_info(doc_text)  
-
-					if ' (rozcestník)' in page_title or page_title.lower() == 'hlavní strana':
-						continue
-
-					page_title = re.sub(r' \([^\)]*\)$', '', page_title)
-
-					# write data to specific files:
-					paragraphs_file.write(page_uri + '\t' + page_first_paragraph + '\n')
-
-					
-					# replace '/' in the #title with %2F - its URL escape - because '/' is forbidden in filenames
-					escaped_page_title = re.sub(r'/', r'%2F', page_title) 
-					temp_filename = "wp_" + escaped_page_title # filename: wp_ (as wikipage) + page title
-					temp_dir = os.path.join(fulltexts_dir, "d_" + get_dir_name_fulltexts(escaped_page_title)) # dirname - use first two letters of the page title
-					if not os.path.exists(temp_dir):
-						os.makedirs(temp_dir)
-
-					temp_fulltext_file = open(os.path.join(temp_dir, temp_filename + '.txt'), "w")
-					temp_fulltext_file.write(page_fulltext) 
-					temp_fulltext_file.close()
-				
-					entity_line = "{}\t{}\t{}\t{}".format(page_id, page_uri, page_title, page_first_paragraph)
-					knowledgebase_file.write(entity_line + '\n')
-
-					log_totalpagecount += 1
-					# logging
-					if log_totalpagecount % log_pagechunk == 0:
-						logger.info("Processed {} pages".format(log_totalpagecount))
-
-
-				elif line == "": # end of file reached
-					break
-				else:
-					continue
+			if page_revid:
+				if not revisions_file:
+					revisions_file = open(os.path.join(outputdir, revisions_file_name), "w")
+				revisions_file.write(page_id + '\t' + page_revid + '\n')
+
+			log_totalpagecount += 1
+			# logging
+			if log_totalpagecount % log_pagechunk == 0:
+				logger.info("Processed {} pages".format(log_totalpagecount))
+
+	if pool:
+		pool.close()
+		pool.join()
 
 	# Close opened files:
 	paragraphs_file.close()
 	knowledgebase_file.close()
+	if revisions_file:
+		revisions_file.close()
+	fulltexts_writer.close()
+	logger.info("Fulltexts: {} articles, {} bytes written, {:.2f} s spent waiting for the writes.".format(
+					fulltexts_writer.files_written, fulltexts_writer.bytes_written, fulltexts_writer.blocked_time))
 
 	logger.info("==== Extraction complete : Pages processed: {} ====".format(log_totalpagecount))
 
@@ -146,7 +139,7 @@ def perform_extraction(dumpdir:str, outputdir:str, logger:logging.Logger) -> Non
 
 def extract_page_info(doc_text:str) -> (str, str, str, str, str):
 	"""Extract following information from HTML preprocesssed wikipage as tuple with this order:
-		(title, uri, id, first sentence, first paragraph, full text).
+		(title, uri, id, first paragraph, full text).
 		 This method is called inside perfom_extraction method for each wikipage html it reads from the preprocessed dump."""
 
 	page_title = ''
@@ -155,18 +148,130 @@ def extract_page_info(doc_text:str) -> (str, str, str, str, str):
 	page_first_paragraph = ''
 	page_fulltext = ''
 	
-	doc_text = html.unescape(doc_text)
+	doc_text = unescape_page(doc_text)
 	# A little bug-counter - input html contains '&amp;nbsp' instead of '&nbsp', so 
 	# after the first html.unescape() strings '&nbsp' are left in the text (and maybe this goes for more html entities)
-	doc_text = html.unescape(doc_text)
+	doc_text = unescape_page(doc_text)
 
 
 	# extract title, uri and id:
-	pattern_header = re.compile(r'<doc\s+id="(\d+)"\s+url="([^"]+)"\s+title="(.+?)">')
-	page_id, page_uri, page_title = pattern_header.findall(doc_text)[0] 
+	page_id, page_uri, page_title = pattern_header.search(doc_text).groups()
 	# URI contains ID, not the title - replace that (in title spaces must be replaced with '_' for this)
 	page_uri = re.sub(r'\?.+', r'/{}'.format(re.sub(r' ', r'_', page_title)), page_uri, 1)
-	
+
+	page_first_paragraph, page_fulltext = convert_doc_html(doc_text)
+
+	return (page_title, page_uri, page_id, page_first_paragraph, page_fulltext)
+
+
+def unescape_page(doc_text:str) -> str:
+	"""Same as html.unescape(), faster for WikiExtractor output where most of the entities are escaped tags.
+	'&lt;' and '&gt;' are replaced without the regex callback of html.unescape(), which gives the same result,
+	because neither '&' nor '<' can be a part of the entity matched before them."""
+
+	return html.unescape(doc_text.replace('&lt;', '<').replace('&gt;', '>'))
+
+
+# <doc> header of a page in WikiExtractor output
+pattern_header = re.compile(r'<doc\s+id="(\d+)"(?:\s+revid="[^"]*")?\s+url="([^"]+)"\s+title="(.+?)">')
+
+# Everything convert_doc_html() has to look at in an unescaped page: <doc> elements, links, tags and stray '<' characters
+pattern_doc_token = re.compile(r'</?doc[^<>\n]*>|<a href="[^"<]+">([^<]+)</a>|<(/?\w+)>|<')
+
+# Stray '<' that convert_doc_html() can not handle: start of a <doc> element or link it did not match,
+# or '<' which becomes a tag after an element next to it is removed (e.g. '<b</li>>' in the full text)
+pattern_stray_lt = re.compile(r'<(?:/?doc|a href="|/?\w*(?:</?doc|<a href="|<h\d>|</?[ou]l>|</li>|</?dl>|</d[td]>))')
+
+pattern_newlines = re.compile(r'\n+')
+
+# What the tags are replaced with in the full text, other tags are removed
+fulltext_tag_replacements = {'br': '\n', 'li': '* ', 'dt': '* ', 'dd': ' `-> '}
+for n in range(1, 7):
+	fulltext_tag_replacements['h{}'.format(n)] = fulltext_tag_replacements['/h{}'.format(n)] = ' ' + '='*n + ' '
+
+
+def convert_doc_html(doc_text:str) -> (str, str):
+	"""Converts unescaped HTML of a wikipage (from <doc ...> to </doc>) into tuple (first paragraph, full text).
+	The result is the same as of convert_doc_html_cascade(), but the page is walked through only once for the full text
+	and the first paragraph is read only from the beginning of the page."""
+
+	harmful_stray_lt = []
+
+	def fulltext_replacement(m):
+		if m.lastindex == 2: # tag
+			return fulltext_tag_replacements.get(m.group(2), '')
+		elif m.lastindex == 1: # link
+			return m.group(1)
+		elif len(m.group()) == 1: # stray '<', e.g. "a < b" or "</<li>" from WikiExtractor
+			if pattern_stray_lt.match(doc_text, m.start()):
+				harmful_stray_lt.append(m.start())
+			return '<'
+		else: # <doc> element
+			return ''
+
+	page_fulltext = pattern_doc_token.sub(fulltext_replacement, doc_text)
+	if harmful_stray_lt:
+		return convert_doc_html_cascade(doc_text)
+
+	# collapse multiple newlines into one newline (<=> delete empty lines), remove ending and trailing whitespace
+	page_fulltext = pattern_newlines.sub('\n', page_fulltext).strip()
+
+	return (first_paragraph(doc_text), page_fulltext)
+
+
+def first_paragraph(doc_text:str) -> str:
+	"""Returns first paragraph of unescaped HTML of a wikipage - first line that is not empty after headings
+	(together with their content) and tags are removed. Helper of convert_doc_html(), reads the page only
+	until the first paragraph is known."""
+
+	paragraph_pieces = []
+	heading_start = None # index into paragraph_pieces where a heading opened on the current line began
+
+	cur = 0
+	for m in pattern_doc_token.finditer(doc_text):
+		text = doc_text[cur:m.start()]
+		cur = m.end()
+		link_text, tag = m.groups()
+
+		if link_text is not None: # <a href="...">text</a>
+			text += link_text
+		elif tag is None and len(m.group()) == 1: # stray '<'
+			text += '<'
+
+		if text:
+			paragraph_pieces.append(text)
+			if '\n' in text:
+				# heading is removed only when it is closed on the same line
+				heading_start = None
+				# first paragraph is known once another non-empty line follows it
+				paragraphs = pattern_newlines.sub('\n', ''.join(paragraph_pieces)).strip()
+				if '\n' in paragraphs:
+					return paragraphs.split('\n', 1)[0]
+				elif not paragraphs:
+					paragraph_pieces = [] # only whitespace so far, it would be stripped anyway
+
+		if tag:
+			if len(tag) == 2 and tag[0] == 'h' and tag[1].isdecimal():
+				if heading_start is None:
+					heading_start = len(paragraph_pieces)
+			elif len(tag) == 3 and tag[:2] == '/h' and tag[2].isdecimal() and heading_start is not None:
+				del paragraph_pieces[heading_start:]
+				heading_start = None
+
+	paragraph_pieces.append(doc_text[cur:])
+
+	# collapse multiple newlines into one newline (<=> delete empty lines), remove ending and trailing whitespace
+	paragraphs = pattern_newlines.sub('\n', ''.join(paragraph_pieces)).strip()
+
+	# Extract first paragraph (this makes assumptions about the input format - 
+	# each paragraph seems to be on a separate line)
+	return paragraphs.split("\n", 1)[0]
+
+
+def convert_doc_html_cascade(doc_text:str) -> (str, str):
+	"""Same as convert_doc_html(), but done by a sequence of substitutions over the whole page.
+	Used for pages the single walk can not handle exactly."""
+
 	# remove opening and ending <doc> elements
 	doc_text = re.sub(r'</?doc.*?>', r'', doc_text) 
 
@@ -226,8 +331,7 @@ def extract_page_info(doc_text:str) -> (str, str, str, str, str):
 	# remove ending and trailing if there are any
 	page_fulltext = page_fulltext.strip()
 
-
-	return (page_title, page_uri, page_id, page_first_paragraph, page_fulltext)
+	return (page_first_paragraph, page_fulltext)
 
 
 
@@ -235,7 +339,9 @@ def extract_page_info(doc_text:str) -> (str, str, str, str, str):
 options = SimpleNamespace(
 						datadir='', 
 						outputdir='', 
-						logfile=''
+						logfile='',
+						processes=1,
+						archive=False
 		)
 
 
@@ -254,6 +360,9 @@ def main(argList:list = None) -> None:
 									(the directory that contains directories 'AA', 'AB', 'AC' ...).""",required=True)
 	argParser.add_argument('-o', '--outputdir', help="""Path to a directory where this extractor puts its results.""", required=True)
 	argParser.add_argument('-l', '--logfile', help="""Write script info messages and error into logfile (by default written only to stderr).""")
+	argParser.add_argument('-p', '--processes', type=int, default=1, help="""Number of processes converting the HTML dump files in parallel (default 1).""")
+	argParser.add_argument('-a', '--archive', action='store_true', help="""Pack full texts into shard files 'fulltexts/d_XX.txt' with index 'fulltexts/index.txt'
+									instead of writing one file per article (read them with fulltexts.FulltextArchive).""")
 	
 
 ### Read arguments from terminal/shell or from the main() method argument list, if it's not empty
@@ -267,6 +376,8 @@ def main(argList:list = None) -> None:
 	options.datadir = args.datadir
 	options.outputdir = args.outputdir
 	options.logfile = args.logfile
+	options.processes = args.processes
+	options.archive = args.archive
 
 	# Setup module LOGGER
 	logger = logging.getLogger(__file__)
@@ -315,7 +426,7 @@ def main(argList:list = None) -> None:
 		logger.error("==== Script terminating with exit status [1] ====")
 		sys.exit(1)
 	else: # Perform extraction
-		perform_extraction(options.datadir, options.outputdir, logger)
+		perform_extraction(options.datadir, options.outputdir, logger, options.processes, options.archive)
 
 	logger.info("==== Scrip succesfully finished with exit status [0] ====")
 	sys.exit()
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+#########################################################################################################################################
+###
+### Reader of the intermediary dump created by WikiExtractor.py (directories 'AA', 'AB', ... with files 'wiki_00', 'wiki_01', ...).
+### Pages are yielded as Doc records, files are read in large chunks and split on the <doc ...> and </doc> lines.
+### USAGE: for doc in dump_reader.read_dump(preprocessed_dump_dir): ...
+###
+#########################################################################################################################################
+
+
+import os.path
+import re
+import html
+import logging
+
+from collections import namedtuple
+
+
+## Page from the dump:
+##	id, url, title - attributes of the <doc> element (unescaped)
+##	text - the page from <doc ...> to </doc>, lines are stripped (blank lines are kept)
+##	revid - revision id, if WikiExtractor.py was run with --revision (else '')
+Doc = namedtuple('Doc', ['id', 'url', 'title', 'text', 'revid'])
+
+# how many characters are read from a file at once
+chunk_size = 4 * 1024 * 1024
+
+# whitespace at the beginning of a line (searched also in reversed text - whitespace at the end of a line,
+# a pattern starting with '\n' is much faster to search for than r'[^\S\n]\n')
+pattern_line_start_whitespace = re.compile(r'\n[^\S\n]')
+# attributes of <doc>
+pattern_header = re.compile(r'<doc\s+id="(\d+)"(?:\s+revid="([^"]*)")?\s+url="([^"]+)"\s+title="(.+?)">')
+
+
+def dump_files(dumpdir:str) -> list:
+	"""Returns paths of all files in every subdirectory of 'dumpdir' (the WikiExtractor output files 'AA/wiki_00', ...),
+	in the order in which read_dump() reads them."""
+
+	### WARNING!: iterates over overy file in every subdirectory of 'dumpdir'!
+	### Make sure no other subdirectories or files are in there
+	file_paths = []
+	for subdir in [os.path.join(dumpdir,node) for node in os.listdir(dumpdir) if os.path.isdir(os.path.join(dumpdir, node))]:
+		for file_path in [os.path.join(subdir, node) for node in os.listdir(subdir) if os.path.isfile(os.path.join(subdir, node))]:
+			file_paths.append(file_path)
+	return file_paths
+
+
+def read_docs(file_path:str, logger:logging.Logger = None):
+	"""Generator of Doc records of all pages in one file of the dump. Page begins on a line starting with <doc
+	and ends on a line with </doc>. A page that is not finished at the end of the file is left out (and logged)."""
+
+	with open(file_path, "r") as dump_file:
+		buffer = ''
+		while True:
+			chunk = dump_file.read(chunk_size)
+			if chunk:
+				buffer += chunk
+			else:
+				buffer += '\n' # end of file finishes the last line
+
+			cur = 0 # end of the last page found in buffer
+			while True:
+				doc_start, doc_end = find_doc(buffer, cur)
+				if doc_start < 0:
+					break
+				yield make_doc(buffer[doc_start:doc_end])
+				cur = doc_end
+			buffer = buffer[cur:]
+
+			if not chunk:
+				break
+
+	if '<doc' in buffer and logger:
+		logger.warning("File {} ends before </doc> of its last page, the page is skipped.".format(file_path))
+
+
+def find_doc(buffer:str, pos:int) -> (int, int):
+	"""Finds first page in 'buffer' after 'pos' and returns (start, end) of the text from <doc ...> to </doc>.
+	Returns (-1, -1) if there is no page whose </doc> line is complete in 'buffer'."""
+
+	# usual layout written by WikiExtractor - <doc right after the previous page, no whitespace around </doc>
+	doc_start = pos + 1 if buffer.startswith('\n<doc', pos) else pos
+	end_tag = buffer.find('\n</doc>\n', doc_start)
+	if end_tag >= 0 and buffer.startswith('<doc', doc_start) and buffer.find('</doc>', doc_start, end_tag) < 0:
+		return (doc_start, end_tag + 7)
+
+	# <doc at the beginning of a line
+	doc_start = buffer.find('<doc', pos)
+	while doc_start >= 0 and not is_blank(buffer, buffer.rfind('\n', 0, doc_start) + 1, doc_start):
+		doc_start = buffer.find('<doc', doc_start + 1)
+	if doc_start < 0:
+		return (-1, -1)
+
+	# </doc> alone on one of the following lines
+	header_end = buffer.find('\n', doc_start)
+	if header_end < 0:
+		return (-1, -1)
+	end_tag = buffer.find('</doc>', header_end + 1)
+	while end_tag >= 0:
+		line_end = buffer.find('\n', end_tag)
+		if line_end < 0:
+			break
+		if is_blank(buffer, buffer.rfind('\n', 0, end_tag) + 1, end_tag) and is_blank(buffer, end_tag + 6, line_end):
+			return (doc_start, end_tag + 6)
+		end_tag = buffer.find('</doc>', end_tag + 1)
+
+	return (-1, -1)
+
+
+def is_blank(buffer:str, start:int, end:int) -> bool:
+	"""Whether there is only whitespace in buffer[start:end]"""
+	return start >= end or buffer[start:end].isspace()
+
+
+def read_dump(dumpdir:str, logger:logging.Logger = None):
+	"""Generator of Doc records of all pages in the dump directory 'dumpdir'."""
+
+	for file_path in dump_files(dumpdir):
+		for doc in read_docs(file_path, logger):
+			yield doc
+
+
+def make_doc(doc_html:str) -> Doc:
+	"""Creates Doc record from the text of a page (from <doc ...> to </doc>)."""
+
+	text = doc_html
+	if pattern_line_start_whitespace.search(text) or pattern_line_start_whitespace.search(text[::-1]):
+		text = '\n'.join([line.strip() for line in text.split('\n')])
+
+	header = text[:text.find('\n')]
+	# entities are escaped twice in WikiExtractor output (see czechwiki_extractor.extract_page_info)
+	m = pattern_header.search(html.unescape(html.unescape(header)))
+	if m:
+		id, revid, url, title = m.groups()
+	else:
+		id, revid, url, title = '', '', '', ''
+
+	return Doc(id, url, title, text, revid or '')
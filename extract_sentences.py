@@ -12,21 +12,37 @@ import re
 import os.path
 import logging
 import sys
+import multiprocessing
+import functools
 
 import requests
-from ufal.udpipe import Model, Pipeline, ProcessingError
+from ufal.udpipe import Model, Pipeline, ProcessingError, Sentence
 
 
-def extract_sentences(input_file:str, output_file:str, logger) -> None:
+lang_model = 'lang_models/czech-ud-2.0-170801.udpipe'
+
+## UDPipe model, loaded in extract_sentences() before the worker processes are forked (they share its memory)
+ud_model = None
+## UDPipe pipeline of the current process, created on the first use
+ud_pipeline = None
+## UDPipe tokenizer of the current process (tokenizer only mode), created on the first use
+ud_tokenizer = None
+## Token ranges of the tokenizer continue from one text to the next, this is where the next text begins
+ud_tokenizer_offset = 0
+
+
+def extract_sentences(input_file:str, output_file:str, logger, batch_size:int = 100, processes:int = 1, tokenizer_only:bool = False) -> None:
+	"""Writes URI and first sentence of every paragraph from 'input_file' into 'output_file'.
+	Paragraphs are processed in batches of 'batch_size' by a pool of 'processes' worker processes,
+	each with its own UDPipe pipeline. The output is the same for any batch size and number of processes.
+	With 'tokenizer_only' the sentences are found by the UDPipe tokenizer alone (see first_sentence_span)."""
+	global ud_model
 	
 	logger.info("==== Now performing sentence extraction from paragraphs file ====")
 	# UDPipe initliazation
-	lang_model = 'lang_models/czech-ud-2.0-170801.udpipe' 
-	model = Model.load(lang_model)
-	if not model:
+	ud_model = Model.load(lang_model)
+	if not ud_model:
 		logger.error('Could not load UDPipe language model: ' + lang_model)
-	ud_pipeline = Pipeline(model, 'tokenize', Pipeline.DEFAULT, Pipeline.DEFAULT, '')
-	ud_error = ProcessingError()
 
 	sentences_file = open(output_file, "w")
 	# reopen paragraphs for reading
@@ -34,26 +50,23 @@ def extract_sentences(input_file:str, output_file:str, logger) -> None:
 	
 	sentences_count = 0
 
-	for p_line in paragraphs_file:
-		page_first_sentence = ""
-		page_first_paragraph = p_line.split('\t', 1) # use the variable as temporary list
+	process_batch = functools.partial(first_sentences, tokenizer_only=tokenizer_only)
 
-		# If there is a paragraph content
-		if len(page_first_paragraph) == 2:
-			page_uri = page_first_paragraph[0]
-			page_first_paragraph = page_first_paragraph[1]
-			# Extract first sentence form paragraph using UDPipe:
-			ud_output = ud_pipeline.process(page_first_paragraph, ud_error)
-			if ud_error.occurred():
-				logger.error('Error occured while extracting sentence using UDPipe: ' + ud_error.message)
-				page_first_sentence = ""
-			else:
-				ud_output = ud_output.split('\n')
-				if len(ud_output) >= 4 :
-					page_first_sentence = ud_output[3][9:] # assumption about the output format 
-				else:
-					page_first_sentence = ""
-			
+	# The SWIG binding of UDPipe holds the GIL, so the batches are processed in processes, not threads.
+	# Pool.imap() returns the results in the order of the batches.
+	if processes > 1:
+		logger.info("Using {} processes.".format(processes))
+		pool = multiprocessing.Pool(processes)
+		results = pool.imap(process_batch, read_batches(paragraphs_file, batch_size))
+	else:
+		pool = None
+		results = map(process_batch, read_batches(paragraphs_file, batch_size))
+
+	for page_uris, page_first_sentences, ud_errors in results:
+		for ud_error_message in ud_errors:
+			logger.error('Error occured while extracting sentence using UDPipe: ' + ud_error_message)
+
+		for page_uri, page_first_sentence in zip(page_uris, page_first_sentences):
 			# Write sentence to the file
 			sentences_file.write(page_uri + '\t' + page_first_sentence + '\n')
 			
@@ -61,6 +74,9 @@ def extract_sentences(input_file:str, output_file:str, logger) -> None:
 			if sentences_count % 2000 == 0 :
 				logger.info("Extracted {} sentences.".format(sentences_count))
 
+	if pool:
+		pool.close()
+		pool.join()
 
 	logger.info("Finished extraction of {} sentences.".format(sentences_count))
 
@@ -68,6 +84,98 @@ def extract_sentences(input_file:str, output_file:str, logger) -> None:
 	sentences_file.close()
 
 
+def read_batches(paragraphs_file, batch_size:int):
+	"""Generator of batches (page URIs, paragraphs) of at most 'batch_size' lines from the paragraphs file.
+	Lines without a paragraph content are left out."""
+
+	page_uris, page_paragraphs = [], []
+	for p_line in paragraphs_file:
+		page_first_paragraph = p_line.split('\t', 1) # use the variable as temporary list
+
+		# If there is a paragraph content
+		if len(page_first_paragraph) == 2:
+			page_uris.append(page_first_paragraph[0])
+			page_paragraphs.append(page_first_paragraph[1])
+			if len(page_uris) >= batch_size:
+				yield (page_uris, page_paragraphs)
+				page_uris, page_paragraphs = [], []
+
+	if page_uris:
+		yield (page_uris, page_paragraphs)
+
+
+def first_sentences(batch:(list, list), tokenizer_only:bool = False) -> (list, list, list):
+	"""Extracts first sentence of each paragraph in 'batch' (page URIs, paragraphs) using UDPipe.
+	Returns (page URIs, first sentences, messages of UDPipe errors)."""
+	global ud_pipeline
+
+	page_uris, page_paragraphs = batch
+	ud_errors = []
+
+	if tokenizer_only:
+		page_first_sentences = []
+		for paragraph in page_paragraphs:
+			start, end = first_sentence_span(paragraph, ud_errors)
+			page_first_sentences.append(paragraph[start:end])
+		return (page_uris, page_first_sentences, ud_errors)
+
+	if ud_pipeline is None:
+		ud_pipeline = Pipeline(ud_model, 'tokenize', Pipeline.DEFAULT, Pipeline.DEFAULT, '')
+
+	# Each paragraph is processed by a separate call - the tokenizer splits sentences differently
+	# when the paragraphs are joined into one text (and the call overhead is negligible compared to tagging and parsing)
+	page_first_sentences = [first_sentence(paragraph, ud_errors) for paragraph in page_paragraphs]
+
+	return (page_uris, page_first_sentences, ud_errors)
+
+
+def first_sentence(paragraph:str, ud_errors:list) -> str:
+	"""Extracts first sentence of one paragraph using UDPipe. Message of an error is appended to 'ud_errors'."""
+
+	ud_error = ProcessingError()
+	ud_output = ud_pipeline.process(paragraph, ud_error)
+	if ud_error.occurred():
+		ud_errors.append(ud_error.message)
+		return ""
+
+	ud_output = ud_output.split('\n')
+	if len(ud_output) >= 4 :
+		return ud_output[3][9:] # assumption about the output format 
+	else:
+		return ""
+
+
+def first_sentence_span(paragraph:str, ud_errors:list) -> (int, int):
+	"""Finds the first sentence of the paragraph using only the UDPipe tokenizer - without tagging, parsing
+	and the CoNLL-U output - the paragraph is tokenized only up to the end of the first sentence.
+	Returns (start, end) of the sentence in 'paragraph', (0, 0) if there is none.
+	Message of an error is appended to 'ud_errors'."""
+	global ud_tokenizer, ud_tokenizer_offset
+
+	if ud_tokenizer is None:
+		ud_tokenizer = ud_model.newTokenizer('ranges')
+		ud_tokenizer_offset = 0
+	ud_tokenizer.setText(paragraph)
+	text_start = ud_tokenizer_offset
+	text_end = text_start + len(paragraph)
+	ud_tokenizer_offset = text_end
+
+	sentence = Sentence()
+	ud_error = ProcessingError()
+	if not ud_tokenizer.nextSentence(sentence, ud_error):
+		if ud_error.occurred():
+			ud_errors.append(ud_error.message)
+		return (0, 0)
+
+	# words[0] is the technical root, words of multiword tokens have no range (the multiword token has it)
+	ranges = [(token.getTokenRangeStart(), token.getTokenRangeEnd()) for token in list(sentence.words)[1:] + list(sentence.multiwordTokens)]
+	ranges = [(start, end) for start, end in ranges if text_start <= start <= end <= text_end]
+	if not ranges:
+		return (0, 0)
+
+	return (min(ranges)[0] - text_start, max([end for start, end in ranges]) - text_start)
+
+
 
 
 def main(argList:list = None) -> None:
@@ -82,6 +190,10 @@ def main(argList:list = None) -> None:
 
 	argParser.add_argument('-i', '--input', help="""Path to the paragraphs file.""", required=True)
 	argParser.add_argument('-o', '--output', help="""Path to an output file.""", required=True)
+	argParser.add_argument('-b', '--batch', type=int, default=100, help="""Number of paragraphs passed to a worker process at once (default 100).""")
+	argParser.add_argument('-p', '--processes', type=int, default=1, help="""Number of processes running UDPipe in parallel (default 1).""")
+	argParser.add_argument('-t', '--tokenizer-only', action='store_true', help="""Find the first sentence only by the UDPipe tokenizer, without tagging and parsing
+									(much faster, the sentence is copied from the paragraph including its whitespace).""")
 		
 	argParser.add_argument('-l', '--logfile', help="""Write script info messages and error into logfile (by default written only to stderr).""")
 	
@@ -123,7 +235,7 @@ def main(argList:list = None) -> None:
 		logger.error("==== Script terminating with exit status [1] ====")
 		sys.exit(1)
 	else: # Perform extraction
-		extract_sentences(args.input, args.output, logger)
+		extract_sentences(args.input, args.output, logger, args.batch, args.processes, args.tokenizer_only)
 
 	logger.info("==== Scrip succesfully finished with exit status [0] ====")
 	sys.exit()
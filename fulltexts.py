@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+#########################################################################################################################################
+###
+### Storage of article full texts extracted by czechwiki_extractor.py. Two formats:
+###	- files: one file fulltexts/d_XX/wp_<title>.txt per article
+###	- archive: texts appended into a few shard files fulltexts/d_XX.txt, with index fulltexts/index.txt
+###		(one line per article: title, shard, offset and length in bytes, separated by tabs)
+### USAGE: for title, text in fulltexts.FulltextArchive(fulltexts_dir): ...
+###
+#########################################################################################################################################
+
+
+import os.path
+import re
+import time
+import threading
+import queue
+try:
+	import resource
+except ImportError: # not on Unix
+	resource = None
+
+from collections import OrderedDict
+
+
+index_file_name = "index.txt"
+
+# How many shard files are kept open at once. There is a shard for each pair of different uppercase letters
+# (see get_dir_name_fulltexts), 41 * 40 = 1640 for the Czech alphabet, more with titles in other scripts,
+# and titles come in the order of the dump, so the shards are used all at once, not one after another
+max_open_shards = 4096
+# Files left open for everything else (the index, the dump, pipes of worker processes)
+reserved_files = 64
+
+# Threads writing the per article files and how many files can wait for them before write() blocks
+writer_threads = 4
+max_pending_writes = 256
+
+
+def get_dir_name_fulltexts(title:str) -> str:
+	"""Little helper method. Returns name of a directory in which the article should be put
+	while sorting, based on the title of the article."""
+
+	t_numeric = "numeric" #title begins with a number
+	t_alphaXX = "alpha_XX" # title has the same two letters at the beginning
+	t_others = "others"
+	t_alnum = "AlNum" # title begins with letter and number
+
+	if not title: # empty title
+		return t_others
+	elif title[0].isdigit(): # starts with a digit
+		return t_numeric
+	elif len(title) >= 2: # at least two character title
+		if title[0].isalpha() and title[1].isalpha() and title[0].upper() == title[1].upper():
+			return t_alphaXX
+		elif title[0].isalpha() and title[1].isalpha() and title[0].upper() != title[1].upper():
+			return title[0].upper() + title[1].upper()
+		elif title[0].isalpha() and title[1].isdigit():
+				return t_alnum
+		else:
+			return t_others
+	else:
+		return t_others
+
+
+def open_shards_limit() -> int:
+	"""How many shards can be open at once: max_open_shards, or less when the limit of open files (RLIMIT_NOFILE)
+	is lower. Its soft limit is raised towards the hard one if needed."""
+	if not resource:
+		return min(max_open_shards, 512 - reserved_files) # default limit of the C runtime on Windows
+	soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+	wanted = max_open_shards + reserved_files
+	if soft != resource.RLIM_INFINITY and soft < wanted:
+		raised = wanted if hard == resource.RLIM_INFINITY else min(hard, wanted)
+		try:
+			resource.setrlimit(resource.RLIMIT_NOFILE, (raised, hard))
+			soft = raised
+		except (ValueError, OSError):
+			pass
+	if soft == resource.RLIM_INFINITY:
+		return max_open_shards
+	return max(1, min(max_open_shards, soft - reserved_files))
+
+
+def escape_title(title:str) -> str:
+	"""Replace '/' in the title with %2F - its URL escape - because '/' is forbidden in filenames"""
+	return re.sub(r'/', r'%2F', title)
+
+
+class ShardFiles(object):
+	"""
+	Open files of shards, at most open_shards_limit() of them, the least recently used are closed.
+	"""
+
+	def __init__(self, fulltexts_dir:str, mode:str):
+		"""
+		:param fulltexts_dir: directory with the shards.
+		:param mode: 'wb' (shards are truncated when they are opened for the first time), or 'rb'.
+		"""
+		self.fulltexts_dir = fulltexts_dir
+		self.mode = mode
+		self.files = OrderedDict()
+		self.opened = set() # shards opened at least once
+		self.max_open = open_shards_limit()
+
+	def get(self, shard:str):
+		shard_file = self.files.get(shard)
+		if shard_file:
+			self.files.move_to_end(shard)
+			return shard_file
+
+		if len(self.files) >= self.max_open:
+			self.files.popitem(last=False)[1].close()
+		mode = self.mode
+		if mode == 'wb' and shard in self.opened:
+			mode = 'ab' # reopened after it was closed, continue at the end
+		shard_file = open(os.path.join(self.fulltexts_dir, shard), mode)
+		self.files[shard] = shard_file
+		self.opened.add(shard)
+		return shard_file
+
+	def close(self):
+		for shard_file in self.files.values():
+			shard_file.close()
+		self.files.clear()
+
+
+class FulltextFiles(object):
+	"""
+	Writes each full text to its own file fulltexts/d_XX/wp_<title>.txt.
+	Files are written by background threads, write() only blocks when max_pending_writes files are waiting.
+	The same file is always written by the same thread, so of more articles with the same title the last one is kept.
+	Counters: files_written, bytes_written, blocked_time (seconds the caller waited in write() and close()).
+	"""
+
+	def __init__(self, fulltexts_dir:str, threads:int = writer_threads, max_pending:int = max_pending_writes):
+		self.fulltexts_dir = fulltexts_dir
+		self.created_dirs = set()
+		self.files_written = 0
+		self.bytes_written = 0
+		self.blocked_time = 0.0
+		self.error = None # first exception raised in a writing thread
+		self.lock = threading.Lock()
+		self.queues = [queue.Queue(max(1, max_pending // threads)) for _ in range(threads)]
+		self.threads = [] # started with the first write (not before, e.g. a multiprocessing.Pool can be forked in between)
+
+	def write(self, title:str, text:str):
+		if self.error:
+			raise self.error
+
+		escaped_title = escape_title(title)
+		filename = "wp_" + escaped_title # filename: wp_ (as wikipage) + page title
+		directory = os.path.join(self.fulltexts_dir, "d_" + get_dir_name_fulltexts(escaped_title)) # dirname - use first two letters of the page title
+		if directory not in self.created_dirs:
+			os.makedirs(directory, exist_ok=True)
+			self.created_dirs.add(directory)
+
+		if not self.threads:
+			for write_queue in self.queues:
+				thread = threading.Thread(target=self.write_files, args=(write_queue,), daemon=True)
+				thread.start()
+				self.threads.append(thread)
+
+		file_path = os.path.join(directory, filename + '.txt')
+		write_queue = self.queues[hash(file_path) % len(self.queues)]
+		start = time.time()
+		write_queue.put((file_path, text))
+		self.blocked_time += time.time() - start
+
+	def write_files(self, write_queue:queue.Queue):
+		"""Writing thread, ends on None from the queue."""
+		while True:
+			item = write_queue.get()
+			if item is None:
+				break
+			if self.error:
+				continue # drain the queue, so write() does not block forever
+
+			file_path, text = item
+			try:
+				fulltext_file = open(file_path, "w")
+				fulltext_file.write(text)
+				size = fulltext_file.tell()
+				fulltext_file.close()
+			except Exception as e:
+				self.error = e
+				continue
+			with self.lock:
+				self.files_written += 1
+				self.bytes_written += size
+
+	def close(self):
+		"""Waits until all files are written. Raises the exception of a failed write, if there was any."""
+		start = time.time()
+		for write_queue in self.queues[:len(self.threads)]:
+			write_queue.put(None)
+		for thread in self.threads:
+			thread.join()
+		self.threads = []
+		self.blocked_time += time.time() - start
+		if self.error:
+			raise self.error
+
+
+class FulltextArchiveWriter(object):
+	"""
+	Appends full texts into shard files fulltexts/d_XX.txt and records their position in fulltexts/index.txt.
+	Texts are separated by a newline, so the shards are readable as plain text.
+	If more articles have the same title, the last one is used (as if it overwrote the file of the previous one).
+	Counters as in FulltextFiles, writing is synchronous, so blocked_time is the whole time spent in write().
+	"""
+
+	def __init__(self, fulltexts_dir:str):
+		self.fulltexts_dir = fulltexts_dir
+		self.shards = ShardFiles(fulltexts_dir, 'wb')
+		self.index = open(os.path.join(fulltexts_dir, index_file_name), "w")
+		self.files_written = 0
+		self.bytes_written = 0
+		self.blocked_time = 0.0
+
+	def write(self, title:str, text:str):
+		start = time.time()
+		shard = "d_" + get_dir_name_fulltexts(escape_title(title)) + ".txt"
+		shard_file = self.shards.get(shard)
+		data = text.encode('utf-8')
+		offset = shard_file.tell()
+		shard_file.write(data)
+		shard_file.write(b'\n')
+		self.index.write("{}\t{}\t{}\t{}\n".format(title, shard, offset, len(data)))
+		self.files_written += 1
+		self.bytes_written += len(data)
+		self.blocked_time += time.time() - start
+
+	def close(self):
+		self.shards.close()
+		self.index.close()
+
+
+class FulltextArchive(object):
+	"""
+	Reader of full texts written by FulltextArchiveWriter.
+	Random access by title - archive[title], archive.get(title), iteration of (title, text) goes shard by shard.
+	"""
+
+	def __init__(self, fulltexts_dir:str):
+		self.fulltexts_dir = fulltexts_dir
+		self.shards = ShardFiles(fulltexts_dir, 'rb')
+		self.index = {} # title -> (shard, offset, length)
+		with open(os.path.join(fulltexts_dir, index_file_name), "r") as index_file:
+			for line in index_file:
+				title, shard, offset, length = line.rstrip('\n').split('\t')
+				self.index[title] = (shard, int(offset), int(length))
+
+	def __len__(self):
+		return len(self.index)
+
+	def __contains__(self, title:str):
+		return title in self.index
+
+	def __getitem__(self, title:str) -> str:
+		shard, offset, length = self.index[title]
+		shard_file = self.shards.get(shard)
+		shard_file.seek(offset)
+		return shard_file.read(length).decode('utf-8')
+
+	def get(self, title:str, default:str = None) -> str:
+		if title not in self.index:
+			return default
+		return self[title]
+
+	def __iter__(self):
+		"""Yields (title, text) of all articles, in the order in which they are stored in the shards."""
+		entries = sorted(self.index.items(), key=lambda entry: entry[1])
+		for title, (shard, offset, length) in entries:
+			shard_file = self.shards.get(shard)
+			if shard_file.tell() != offset:
+				shard_file.seek(offset)
+			yield (title, shard_file.read(length).decode('utf-8'))
+
+	def close(self):
+		self.shards.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *args):
+		self.close()
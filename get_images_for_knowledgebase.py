@@ -17,42 +17,207 @@ import os.path
 import html
 import logging
 import time
+import threading
+import collections
+import concurrent.futures
 
 import requests
+import requests.adapters
 
+import image_cache
 
 
-def complete_knowledgebase(input_file:str, output_file:str, logger) -> None:
-	### Complete knowledgebase by extracting image URLs
+
+class TokenBucket(object):
+	"""
+	Rate limit shared by the downloading threads: 'rate' tokens per second are added to the bucket
+	(at most 'capacity' of them), every request takes one. Rate 0 means no limit.
+	"""
+
+	def __init__(self, rate:float, capacity:float = 1):
+		self.rate = rate
+		self.capacity = max(1, capacity)
+		self.tokens = self.capacity
+		self.last = time.monotonic()
+		self.lock = threading.Lock()
+
+	def acquire(self) -> None:
+		"""Blocks until there is a token in the bucket and takes it."""
+		if self.rate <= 0:
+			return
+		while True:
+			with self.lock:
+				now = time.monotonic()
+				self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+				self.last = now
+				if self.tokens >= 1:
+					self.tokens -= 1
+					return
+				wait = (1 - self.tokens) / self.rate
+			time.sleep(wait)
+
+
+def extract_image_urls(page_html:str) -> str:
+	"""Returns image urls from the html of a wikipage, separated by '|'."""
+
+	imgList = re.findall(r'<img.*?src="//upload\.wikimedia\.org/(.*?)".*?>', page_html)
+	imgList = map(lambda x: re.sub(r'^wikipedia/', 'wikimedia/', x), imgList) # change to local repository schema
+	imgList = map(lambda x: re.sub(r'\|', '\|', x), imgList) # not a same - pattern is escaped, replacement is plain text
+	return '|'.join(set(imgList)) # remove duplicities by converting to set
+
+
+# revision id in the javascript configuration of a wikipage
+pattern_revision_id = re.compile(r'"wgRevisionId":\s*(\d+)')
+
+
+def fetch_image_urls(session:requests.Session, url:str, bucket:TokenBucket, retries:int, backoff:float, logger,
+						cache:image_cache.ImageCache = None, revid:str = '') -> str:
+	"""Downloads the page at 'url' and returns its image urls (see extract_image_urls).
+	Failed requests (connection errors, timeouts, HTTP 429 and 5xx) are repeated up to 'retries' times,
+	waiting 'backoff' seconds before the first retry and twice as long before each next one.
+	With 'cache', a page cached with the same revision id 'revid' is not downloaded at all, other cached pages
+	are requested conditionally (If-None-Match, If-Modified-Since) and their cached images used if the server answers 304.
+	Returns None if the page could not be retrieved."""
+
+	entry = cache.get(url) if cache else None
+	headers = {}
+	if entry:
+		if revid and entry.revid == revid:
+			cache.count('hits')
+			return entry.images
+		if entry.etag:
+			headers['If-None-Match'] = entry.etag
+		if entry.last_modified:
+			headers['If-Modified-Since'] = entry.last_modified
+
+	for attempt in range(retries + 1):
+		if attempt:
+			time.sleep(backoff * 2 ** (attempt - 1))
+		bucket.acquire()
+		try:
+			reqResult = session.get(url, timeout=10, headers=headers)
+		except requests.RequestException as e:
+			error = str(e)
+			continue
+		if reqResult.status_code == 429 or reqResult.status_code >= 500:
+			error = "HTTP status {}".format(reqResult.status_code)
+			continue
+
+		if reqResult.status_code == 304 and entry:
+			cache.put(url, revid or entry.revid, entry.etag, entry.last_modified, entry.images)
+			cache.count('not_modified')
+			return entry.images
+
+		images = extract_image_urls(reqResult.text)
+		if cache and reqResult.status_code == 200:
+			if not revid:
+				m = pattern_revision_id.search(reqResult.text)
+				revid = m.group(1) if m else ''
+			cache.put(url, revid, reqResult.headers.get('ETag', ''), reqResult.headers.get('Last-Modified', ''), images)
+			cache.count('stored')
+		return images
+
+	logger.error("requests.get() failed to retrieve page at {} ({}). Continuing with next url.".format(url, error))
+	return None
+
+
+def complete_knowledgebase(input_file:str, output_file:str, logger, rate:float = 1, concurrency:int = 4,
+							retries:int = 3, backoff:float = 1, server:str = None,
+							cache_file:str = None, cache_size:int = 512 * 1024 * 1024, revisions_file:str = None) -> None:
+	"""Complete knowledgebase by extracting image URLs.
+	Pages are downloaded by 'concurrency' threads over kept-alive connections, together at most 'rate' requests per second
+	(0 = unlimited). Lines are written in the order of the input file.
+	'server' (e.g. http://localhost:8000) replaces scheme and host of the page urls - for testing against a local server.
+	Image lists are kept in 'cache_file' (see fetch_image_urls) of at most 'cache_size' bytes, 'revisions_file'
+	(revisions.txt from czechwiki_extractor.py) gives current revision ids of the pages."""
 	
 	incomplete_knowledgebase_file = open(input_file, "r")
 	kb_file = open(output_file, "w")
 	pages_retrieved = 0
+	start_time = time.time()
 
+	bucket = TokenBucket(rate, capacity=concurrency if rate >= concurrency else 1)
+	cache = image_cache.ImageCache(cache_file, cache_size) if cache_file else None
+	revisions = {} # page id -> revision id
+	if revisions_file:
+		with open(revisions_file, "r") as revisions_lines:
+			for line in revisions_lines:
+				page_id, _, revid = line.rstrip('\n').partition('\t')
+				revisions[page_id] = revid
+	session = requests.Session()
+	adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+	session.mount('http://', adapter)
+	session.mount('https://', adapter)
 
+	with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+		# lines waiting for their images - (line, url, future), written in this order
+		pending = collections.deque()
 
-	for line in incomplete_knowledgebase_file:
-		time.sleep(1) # delay between requests, so we dont overload wikipedia servers
-		url = line.split('\t')[1]
-		kb_line = line[:-1]
-		try:
-			reqResult = requests.get(url,timeout=10)
-			imgList = re.findall(r'<img.*?src="//upload\.wikimedia\.org/(.*?)".*?>', reqResult.text)
-			imgList = map(lambda x: re.sub(r'^wikipedia/', 'wikimedia/', x), imgList) # change to local repository schema
-			imgList = map(lambda x: re.sub(r'\|', '\|', x), imgList) # not a same - pattern is escaped, replacement is plain text
-			kb_line = kb_line + '\t' + '|'.join(set(imgList)) + '\n' # remove duplicities by converting to set
-		except:
-			logger.error("requests.get() failed to retrieve page at {}. Continuing with next url.".format(url))
-			kb_line = kb_line + '\t' + '\n'
+		def write_line(line:str, url:str, future:concurrent.futures.Future) -> None:
+			nonlocal pages_retrieved
+			kb_line = line[:-1]
+			try:
+				imgs = future.result()
+			except Exception as e: # not a failed request (see fetch_image_urls), e.g. an error of the cache
+				logger.error("Failed to get images of page at {} ({!r}). Continuing with next url.".format(url, e))
+				imgs = None
+			kb_line = kb_line + '\t' + (imgs if imgs is not None else '') + '\n'
+			kb_file.write(kb_line) # append the image urls to the knowledgebase and write the complete line to the kb
+
+			# Progress measurement
+			pages_retrieved += 1
+			if pages_retrieved % 100 == 0:
+				logger.info("Processed {} pages ({:.1f} pages/s).".format(pages_retrieved, pages_retrieved / (time.time() - start_time)))
+
+		for line in incomplete_knowledgebase_file:
+			page_id, url = line.split('\t')[:2]
+			if server:
+				url = re.sub(r'^\w+://[^/]*', server.rstrip('/'), url)
+			pending.append((line, url, executor.submit(fetch_image_urls, session, url, bucket, retries, backoff, logger,
+														cache, revisions.get(page_id, ''))))
+			if len(pending) >= 2 * concurrency:
+				write_line(*pending.popleft())
 
-		kb_file.write(kb_line) # append the image urls to the knowledgebase and write the complete line to the kb
+		while pending:
+			write_line(*pending.popleft())
 
-		# Progress measurement
-		pages_retrieved += 1
-		if pages_retrieved % 100 == 0:
-			logger.info("Processed {} pages.".format(pages_retrieved))
+	session.close()
+	if cache:
+		logger.info("Cache: {} unchanged revisions, {} not modified, {} pages downloaded, {} entries evicted.".format(
+					cache.stats['hits'], cache.stats['not_modified'], cache.stats['stored'], cache.stats['evicted']))
+		cache.close()
+
+	logger.info("Done. URLs processed: {} ({:.1f} pages/s).".format(pages_retrieved, pages_retrieved / max(time.time() - start_time, 1e-6)))
+
+	incomplete_knowledgebase_file.close()
+	kb_file.close()
+
+
+def complete_knowledgebase_offline(input_file:str, output_file:str, images_file:str, logger) -> None:
+	"""Complete knowledgebase by image paths collected by WikiExtractor.py --images (without downloading anything).
+	Lines of 'images_file' are: page id, tab and the paths separated by '|'."""
+
+	images = {}
+	with open(images_file, "r") as images_lines:
+		for line in images_lines:
+			page_id, _, paths = line.rstrip('\n').partition('\t')
+			images[page_id] = paths
+
+	incomplete_knowledgebase_file = open(input_file, "r")
+	kb_file = open(output_file, "w")
+	pages_completed = 0
+	pages_missing = 0
+
+	for line in incomplete_knowledgebase_file:
+		page_id = line.split('\t')[0]
+		if page_id not in images:
+			pages_missing += 1
+		kb_file.write(line[:-1] + '\t' + images.get(page_id, '') + '\n')
+		pages_completed += 1
 
-	logger.info("Done. URLs processed: {}.".format(pages_retrieved))
+	if pages_missing:
+		logger.warning("{} pages are not in the images file {}.".format(pages_missing, images_file))
+	logger.info("Done. Pages completed: {}.".format(pages_completed))
 
 	incomplete_knowledgebase_file.close()
 	kb_file.close()
@@ -71,6 +236,18 @@ def main(argList:list = None) -> None:
 	argParser.add_argument('-i', '--input', help="""Incomplete knowledgebase file generated by czechwiki_extractor.py.""",required=True)
 	argParser.add_argument('-o', '--output', help="""Output file - complete knowledgebase.""", required=True)
 	argParser.add_argument('-l', '--logfile', help="""Write script info messages and error into logfile (by default written only to stderr).""")
+	argParser.add_argument('-r', '--rate', type=float, default=1, help="""Maximum number of requests per second, 0 for no limit (default 1).""")
+	argParser.add_argument('-c', '--concurrency', type=int, default=4, help="""Number of requests in flight at once (default 4).""")
+	argParser.add_argument('--retries', type=int, default=3, help="""How many times a failed request is repeated (default 3).""")
+	argParser.add_argument('--backoff', type=float, default=1, help="""Seconds before the first retry, doubled for each next one (default 1).""")
+	argParser.add_argument('--images', help="""Image paths collected by WikiExtractor.py --images - the knowledgebase is completed
+									from this file, without downloading the pages.""")
+	argParser.add_argument('--cache', help="""Cache of downloaded image lists (SQLite file) - on a rerun, only pages whose revision changed are downloaded
+									(pages without a known revision are requested conditionally).""")
+	argParser.add_argument('--cache-size', type=int, default=512, help="""Maximum size of the cache in MB (default 512).""")
+	argParser.add_argument('--revisions', help="""File revisions.txt from czechwiki_extractor.py (page id, revision id) for the cache.""")
+	argParser.add_argument('-s', '--server', help="""Download the pages from this server instead of the one in the urls (e.g. http://localhost:8000 
+									to measure throughput offline against a local stand-in server).""")
 	
 
 ### Read arguments from terminal/shell or from the main() method argument list, if it's not empty
@@ -109,8 +286,11 @@ def main(argList:list = None) -> None:
 	if not optionsValid:
 		logger.error("==== Script terminating with exit status [1] ====")
 		sys.exit(1)
+	elif args.images: # Complete from the images file
+		complete_knowledgebase_offline(args.input, args.output, args.images, logger)
 	else: # Perform extraction
-		complete_knowledgebase(args.input, args.output, logger)
+		complete_knowledgebase(args.input, args.output, logger, args.rate, args.concurrency, args.retries, args.backoff, args.server,
+								args.cache, args.cache_size * 1024 * 1024, args.revisions)
 	logger.info("==== Scrip succesfully finished with exit status [0] ====")
 	sys.exit()
 
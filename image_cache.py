@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+
+#########################################################################################################################################
+###
+### Persistent cache of image lists of wikipages for get_images_for_knowledgebase.py (one SQLite file).
+### Entry of a page (keyed by sha1 of its url) holds the revision id, ETag and Last-Modified of the downloaded page
+### and the image urls extracted from it. The cache is limited by size, least recently used entries are removed.
+### USAGE: cache = image_cache.ImageCache(cache_file, max_size); entry = cache.get(url); cache.put(url, ...)
+###
+#########################################################################################################################################
+
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+from collections import namedtuple, Counter
+
+
+## Cached page:
+##	revid - revision id of the page ('' if not known)
+##	etag, last_modified - headers of the response ('' if there were none), for conditional requests
+##	images - image urls separated by '|' (see get_images_for_knowledgebase.extract_image_urls)
+CacheEntry = namedtuple('CacheEntry', ['url', 'revid', 'etag', 'last_modified', 'images'])
+
+# when the cache grows over its maximum size, entries are removed until it takes this part of it
+evict_to = 0.9
+
+
+class ImageCache(object):
+	"""
+	Cache shared by the downloading threads (all methods are thread safe).
+	Counters in 'stats': 'hits' (revision did not change, no request), 'not_modified' (conditional request
+	answered by 304), 'stored' (downloaded pages), 'evicted'.
+	"""
+
+	def __init__(self, cache_file:str, max_size:int):
+		"""
+		:param cache_file: SQLite database, created if it does not exist.
+		:param max_size: maximum size of the entries in bytes.
+		"""
+		self.max_size = max_size
+		self.stats = Counter()
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(cache_file, check_same_thread=False)
+		self.connection.execute('PRAGMA journal_mode=WAL')
+		self.connection.execute('PRAGMA synchronous=NORMAL')
+		self.connection.execute('''CREATE TABLE IF NOT EXISTS pages (key TEXT PRIMARY KEY, url TEXT, revid TEXT,
+									etag TEXT, last_modified TEXT, images TEXT, size INTEGER, used REAL)''')
+		self.connection.execute('CREATE INDEX IF NOT EXISTS pages_used ON pages (used)')
+		self.connection.commit()
+		self.size = self.connection.execute('SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+		with self.lock:
+			self.evict()
+
+	def get(self, url:str) -> CacheEntry:
+		"""Returns the entry of the page at 'url', None if it is not in the cache."""
+		key = url_key(url)
+		with self.lock:
+			row = self.connection.execute('SELECT url, revid, etag, last_modified, images FROM pages WHERE key = ?', (key,)).fetchone()
+			if not row or row[0] != url:
+				return None
+			self.connection.execute('UPDATE pages SET used = ? WHERE key = ?', (time.time(), key))
+			self.connection.commit()
+		return CacheEntry(*row)
+
+	def put(self, url:str, revid:str, etag:str, last_modified:str, images:str) -> None:
+		"""Stores (or replaces) the entry of the page at 'url'."""
+		key = url_key(url)
+		size = sum(len(value.encode('utf-8')) for value in (url, revid, etag, last_modified, images)) + len(key)
+		with self.lock:
+			row = self.connection.execute('SELECT size FROM pages WHERE key = ?', (key,)).fetchone()
+			self.connection.execute('INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+									(key, url, revid, etag, last_modified, images, size, time.time()))
+			self.size += size - (row[0] if row else 0)
+			if self.size > self.max_size:
+				self.evict()
+			self.connection.commit()
+
+	def count(self, counter:str) -> None:
+		with self.lock:
+			self.stats[counter] += 1
+
+	def evict(self) -> None:
+		"""Removes the least recently used entries, if the cache is bigger than max_size (called with the lock held)."""
+		if self.size <= self.max_size:
+			return
+		cursor = self.connection.execute('SELECT key, size FROM pages ORDER BY used')
+		evicted = []
+		for key, size in cursor:
+			if self.size <= self.max_size * evict_to:
+				break
+			evicted.append((key,))
+			self.size -= size
+		cursor.close()
+		self.connection.executemany('DELETE FROM pages WHERE key = ?', evicted)
+		self.connection.commit()
+		self.stats['evicted'] += len(evicted)
+
+	def close(self) -> None:
+		with self.lock:
+			self.connection.commit()
+			self.connection.close()
+
+
+def url_key(url:str) -> str:
+	return hashlib.sha1(url.encode('utf-8')).hexdigest()
@@ -7,6 +7,7 @@
 ### If the records have the same wikipedia URl, they are considered equal and removed.
 ### Script does not modify any of the existing files, new knowledgebase is put in 
 ### /mnt/minerva1/nlp/projects/czech_wikipedia/results_final/kb_final_filtered.txt.
+### URLs of the existing knowledgebase are kept in an index (see url_index.py), which is rebuilt only when kb_cs changes.
 ###
 #########################################################################################################################################
 
@@ -15,7 +16,11 @@ import sys
 import re
 import os.path
 import logging
+import time
 import urllib.parse
+import functools
+
+import url_index
 
 
 # paths - parameters
@@ -23,56 +28,77 @@ kbhead_existing_path = "/mnt/minerva1/nlp/projects/entity_kb_czech3/xplani02/HEA
 kb_existing_path = "/mnt/data/nlp/projects/entity_kb_czech3/xplani02/kb_cs"
 kb_czech_path = "/mnt/minerva1/nlp/projects/czech_wikipedia/results_final/kb_final.txt"
 kb_result_path = "/mnt/minerva1/nlp/projects/czech_wikipedia/results_final/kb_final_filtered.txt"
+kb_existing_index_path = "/mnt/minerva1/nlp/projects/czech_wikipedia/results_final/kb_cs.urlindex"
+
+# number of -kb_czech- records looked up in the index at once
+batch_size = 10000
 
 
 def remove_existing_records(kbhead_wikiurl_map, kb_existing_path_param, kb_czech_path_param, logger):
-	"""Removes records that are already present in -kb_existing- from -kb_czech'. """
+	"""Removes records that are already present in -kb_existing- from -kb_czech'.
+	-kb_czech- is filtered in batches of lines, records that are not removed are written straight to the result."""
+
+	kb_existing_urls = url_index.UrlIndex(kb_existing_index_path, kb_existing_path_param,
+											functools.partial(existing_url, kbhead_wikiurl_map),
+											repr(sorted(kbhead_wikiurl_map.items())), logger)
+	logger.info("==== Index of existing knowledgebase: {} URLs ====".format(len(kb_existing_urls)))
 
-	kb_existing = open(kb_existing_path_param, "r")
 	kb_czech = open(kb_czech_path_param, "r")
 	kb_result = open(kb_result_path, "w")
 
-	kb_existing_urls = set()
-	kb_czech_lines = []
-
-	for line in kb_existing:
-		line_columns = line.split('\t')
-		protocol_url = line_columns[kbhead_wikiurl_map[line_columns[0]]].strip().split(':', 1) # normalize URL to format without http(s) => //cs.wikipedia.org/...
-		if len(protocol_url) == 2:
-			kb_existing_urls.add(protocol_url[1])
-	
-	for line in kb_czech:
-		kb_czech_lines.append(line)
-
-	i = 0
+	processed = 0
 	removed = 0
-	last = 0
-	while i < len(kb_czech_lines):
-		protocol_url = kb_czech_lines[i].split('\t')[1].strip().split(':', 1) # normalize URL to format without http(s) => //cs.wikipedia.org/...
-
-		if len(protocol_url) != 2:
-			continue
-
-		url = protocol_url[1]
-		url_nonescaped = urllib.parse.unquote(url)
-		url_escaped = urllib.parse.quote(url_nonescaped, safe=':')
-
-		if url in kb_existing_urls or url_nonescaped in kb_existing_urls or url_escaped in kb_existing_urls:
-			del kb_czech_lines[i]
-			removed += 1
-			i = i-1 
-
-		i += 1 
-		if i % 20000 == 0 and i != last:
-			last = i
-			logger.info("==== Processed {} records ====".format(i))
-
-
-
-	for entry in kb_czech_lines:
-		kb_result.write(entry)
-
-	logger.info("==== Script complete. Records removed: {}. Length of the resulting knowledgebase: {} ====".format(removed, i))
+	start_time = time.time()
+	while True:
+		lines = kb_czech.readlines(batch_size * 256) # hint in characters, roughly batch_size lines
+		if not lines:
+			break
+
+		variants = [url_variants(line) for line in lines]
+		found = iter(kb_existing_urls.contains_batch([url for line_variants in variants for url in line_variants]))
+		for line, line_variants in zip(lines, variants):
+			if not any([next(found) for url in line_variants]):
+				kb_result.write(line)
+			else:
+				removed += 1
+
+			processed += 1
+			if processed % 20000 == 0:
+				logger.info("==== Processed {} records ({:.0f} lines/s) ====".format(processed, processed / (time.time() - start_time)))
+
+	kb_czech.close()
+	kb_result.close()
+	kb_existing_urls.close()
+
+	logger.info("==== Script complete. Records removed: {}. Length of the resulting knowledgebase: {} ({:.0f} lines/s) ====".format(
+					removed, processed - removed, processed / max(time.time() - start_time, 1e-6)))
+
+
+def existing_url(kbhead_wikiurl_map, line:str) -> str:
+	"""Returns wikipedia URL (without http(s):) of a record in -kb_existing-, None if it has none."""
+
+	line_columns = line.split('\t')
+	protocol_url = line_columns[kbhead_wikiurl_map[line_columns[0]]].strip().split(':', 1) # normalize URL to format without http(s) => //cs.wikipedia.org/...
+	if len(protocol_url) == 2:
+		return protocol_url[1]
+	return None
+
+
+def url_variants(line:str) -> tuple:
+	"""Returns the URL of a -kb_czech- record normalized to format without http(s) => //cs.wikipedia.org/...,
+	as it is, unescaped and escaped. Empty tuple if the record has no valid URL (such records are kept)."""
+
+	columns = line.split('\t', 2)
+	if len(columns) < 2:
+		return ()
+	protocol_url = columns[1].strip().split(':', 1)
+	if len(protocol_url) != 2:
+		return ()
+
+	url = protocol_url[1]
+	url_nonescaped = urllib.parse.unquote(url)
+	url_escaped = urllib.parse.quote(url_nonescaped, safe=':')
+	return (url, url_nonescaped, url_escaped)
 
 
 def main():
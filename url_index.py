@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+
+#########################################################################################################################################
+###
+### Persistent index of URLs of a knowledgebase (used by remove_existing_records.py for the existing KB kb_cs).
+### Index file: header, sorted 64-bit hashes of the URLs and offsets of their lines in the KB (memory-mapped, nothing is parsed
+### when it is opened). A hash found in the index is checked against the URL on the line of the KB (hash collisions).
+### The index is rebuilt when the KB (its size or modification time) or the way URLs are read from it changes.
+### USAGE: index = url_index.UrlIndex(index_path, kb_path, line_url, version); index.contains_batch(urls)
+###
+#########################################################################################################################################
+
+
+import os
+import os.path
+import mmap
+import array
+import bisect
+import hashlib
+import struct
+
+
+# magic, number of URLs, size and mtime (ns) of the KB, hash of the version
+header_format = '=8sQQQQ'
+header_size = struct.calcsize(header_format)
+magic = b'URLIDX01'
+
+
+def url_hash(url:str) -> int:
+	return int.from_bytes(hashlib.blake2b(url.encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class UrlIndex(object):
+	"""
+	Set of URLs of the lines of a KB, built once and kept in 'index_path'.
+	"""
+
+	def __init__(self, index_path:str, kb_path:str, line_url, version:str = '', logger = None):
+		"""
+		:param index_path: index file, (re)built if it does not exist or does not belong to the current KB.
+		:param kb_path: the knowledgebase.
+		:param line_url: function returning the (normalized) URL of a line of the KB, or None.
+		:param version: anything else the URLs depend on (e.g. which column holds them), the index is rebuilt when it changes.
+		"""
+		self.kb_path = kb_path
+		self.line_url = line_url
+		stat = os.stat(kb_path)
+		self.source = (stat.st_size, stat.st_mtime_ns, url_hash(version))
+
+		if not self.load(index_path):
+			if logger:
+				logger.info("Building URL index {} of {}.".format(index_path, kb_path))
+			self.build(index_path)
+			if not self.load(index_path):
+				raise IOError("Could not load URL index {}.".format(index_path))
+
+		self.kb_file = open(kb_path, "rb")
+		self.kb = mmap.mmap(self.kb_file.fileno(), 0, access=mmap.ACCESS_READ) if stat.st_size else b''
+
+	def load(self, index_path:str) -> bool:
+		"""Maps the index, returns False if it does not exist or is outdated."""
+		if not os.path.exists(index_path) or os.path.getsize(index_path) < header_size:
+			return False
+		index_file = open(index_path, "rb")
+		header = struct.unpack(header_format, index_file.read(header_size))
+		if header[0] != magic or header[2:] != self.source or os.path.getsize(index_path) != header_size + 16 * header[1]:
+			index_file.close()
+			return False
+
+		self.count = header[1]
+		self.index_file = index_file
+		if self.count:
+			self.index = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+			self.hashes = memoryview(self.index)[header_size:header_size + 8 * self.count].cast('Q')
+			self.offsets = memoryview(self.index)[header_size + 8 * self.count:].cast('Q')
+		else:
+			self.index = None
+			self.hashes = self.offsets = ()
+		return True
+
+	def build(self, index_path:str) -> None:
+		# hash and offset of a line in one int, sorting them sorts by the hash
+		entries = []
+		offset = 0
+		with open(self.kb_path, "rb") as kb:
+			for line in kb:
+				url = self.line_url(line.decode('utf-8', errors='replace'))
+				if url is not None:
+					entries.append(url_hash(url) << 64 | offset)
+				offset += len(line)
+		entries.sort()
+
+		hashes = array.array('Q', (entry >> 64 for entry in entries))
+		offsets = array.array('Q', (entry & 0xFFFFFFFFFFFFFFFF for entry in entries))
+		entries = None
+		tmp_path = index_path + '.tmp'
+		with open(tmp_path, "wb") as index_file:
+			index_file.write(struct.pack(header_format, magic, len(hashes), *self.source))
+			hashes.tofile(index_file)
+			offsets.tofile(index_file)
+		os.replace(tmp_path, index_path)
+
+	def __len__(self):
+		return self.count
+
+	def __contains__(self, url:str) -> bool:
+		return self.contains_batch([url])[0]
+
+	def contains_batch(self, urls:list) -> list:
+		"""Returns list of bools - whether each of 'urls' is in the index. URLs are looked up in the order of their hashes,
+		so the search continues in the index from where the previous one ended."""
+		hashes = [url_hash(url) for url in urls]
+		found = [False] * len(urls)
+		lo = 0
+		for i in sorted(range(len(urls)), key=hashes.__getitem__):
+			lo = bisect.bisect_left(self.hashes, hashes[i], lo)
+			j = lo
+			while j < self.count and self.hashes[j] == hashes[i]:
+				if self.url_at(self.offsets[j]) == urls[i]:
+					found[i] = True
+					break
+				j += 1
+		return found
+
+	def url_at(self, offset:int) -> str:
+		end = self.kb.find(b'\n', offset)
+		line = self.kb[offset:end + 1 if end >= 0 else len(self.kb)]
+		return self.line_url(line.decode('utf-8', errors='replace'))
+
+	def close(self) -> None:
+		if self.index:
+			self.hashes.release()
+			self.offsets.release()
+			self.index.close()
+		self.index_file.close()
+		if self.kb:
+			self.kb.close()
+		self.kb_file.close()
@@ -61,14 +61,25 @@ import argparse
 import bz2
 import codecs
 import cgi
+import hashlib
+import heapq
 import fileinput
+import gc
+import gzip
 import logging
+import marshal
+import math
+import mmap
 import os.path
 import re  # TODO use regex when it will be standard
+import tempfile
 import time
 import json
-from io import StringIO
-from multiprocessing import Queue, Process, Value, cpu_count
+from io import StringIO, BytesIO, IOBase, TextIOBase
+from bisect import bisect_left, bisect_right
+from collections import deque, OrderedDict
+from itertools import chain, islice
+from multiprocessing import Queue, Process, Value, Pool, cpu_count
 from timeit import default_timer
 
 
@@ -178,6 +189,22 @@ options = SimpleNamespace(
     ##
     # Minimum expanded text length required to print document
     min_text_length = 0,
+
+    ### MODIFIED_START - image/file references of pages
+    ##
+    # File where to write image/file references of each page (None: do not collect them)
+    images_file = None,
+
+    ##
+    # Names of the File namespace, lowercase. The one from <siteinfo> is added.
+    imageNamespaces = set(['file', 'image', 'soubor', 'obrázek']),
+    ### MODIFIED_END
+
+    ### MODIFIED_START - reader filters
+    ##
+    # Regex, pages with matching titles are skipped by the reader (None: no filter)
+    skipTitle = None,
+    ### MODIFIED_END
     
     # Shared objects holding templates, redirects and cache
     templates = {},
@@ -185,6 +212,16 @@ options = SimpleNamespace(
     # cache of parser templates
     # FIXME: sharing this with a Manager slows down.
     templateCache = {},
+    ### MODIFIED_START - template expansion cache
+    # cache of template expansions of each extract process (None: no cache)
+    expansionCache = None,
+    ### MODIFIED_END
+    ### MODIFIED_START - template profiler
+    # profile of template expansions of each process and its report file
+    # (--profile_templates, None: no profiling)
+    templateProfile = None,
+    templateProfileFile = None,
+    ### MODIFIED_END
     
     # Elements to ignore/discard
     
@@ -204,6 +241,12 @@ options = SimpleNamespace(
 # Keys for Template and Module namespaces
 templateKeys = set(['10', '828'])
 
+### MODIFIED_START - reader filters
+##
+# Keys of namespaces of the extracted pages (see namespaceRule)
+articleKeys = set(['0'])
+### MODIFIED_END
+
 ##
 # Regex for identifying disambig pages
 ### MODIFIED_START
@@ -213,25 +256,80 @@ filter_disambig_page_pattern = re.compile("{{Rozcestník.*?}}")
 
 ##
 # page filtering logic -- remove templates, undesired xml namespaces, and disambiguation pages
-def keepPage(ns, page):
-    if ns != '0':               # Aritcle
-        return False
-
-    # remove disambig pages if desired
-#    if options.filter_disambig_pages:
-#       for line in page:
-#           if filter_disambig_page_pattern.match(line):
-#               return False
-   
-    ### MODIFIED_START - remove Seznamy and Rozcestniky
-    filter_unwanted_patter = re.compile(r'<title>Seznam.*?</title>|{{Seznam.*?}}|{{Rozcestník.*?}}')
-    # Other pages that do not make sense:
-    for line in page:
-        if filter_unwanted_patter.match(line):
-            return False
-    ### MODIFIED_ENND
-    
-    return True
+### MODIFIED_START - page filter chain
+class PageFilter(object):
+    """
+    Chain of rules deciding which pages are extracted: the first rule matching a page removes it.
+    A rule is a pair (name, function(ns, title, text)), the function returns True for pages to remove.
+    Number of removed pages and time spent in each rule are collected in stats
+    (pages_from counts there also pages it skips by namespace and title).
+    """
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.stats = dict((name, [0, 0.0]) for name, rule in rules)  # name -> [removed, seconds]
+
+    def keep(self, ns, title, page):
+        text = page[0] if len(page) == 1 else ''.join(page)
+        for name, rule in self.rules:
+            start = default_timer()
+            remove = rule(ns, title, text)
+            stats = self.stats[name]
+            stats[1] += default_timer() - start
+            if remove:
+                stats[0] += 1
+                return False
+        return True
+
+    def merge(self, stats):
+        """
+        Adds stats of another chain (of a worker process).
+        """
+        for name, (removed, seconds) in stats.items():
+            self.stats[name][0] += removed
+            self.stats[name][1] += seconds
+
+    def report(self):
+        for name, rule in self.rules:
+            removed, seconds = self.stats[name]
+            logging.info("Page filter %s: removed %d pages in %.2fs", name, removed, seconds)
+
+
+def namespaceRule(ns, title, text):
+    return ns not in articleKeys
+
+
+def titleRule(ns, title, text):
+    return options.skipTitle.search(title) is not None
+
+
+# at the start of any line of the page
+unwantedPrefixes = ['{{Seznam', '{{Rozcestník']
+unwantedRE = re.compile(r'{{(?:Seznam|Rozcestník).*?}}')
+
+def unwantedRule(ns, title, text):
+    """
+    Seznamy and Rozcestniky: pages with a line starting by such template.
+    """
+    for prefix in unwantedPrefixes:
+        pos = text.find(prefix)
+        while pos >= 0:
+            if (pos == 0 or text[pos - 1] == '\n') and unwantedRE.match(text, pos):
+                return True
+            pos = text.find(prefix, pos + 1)
+    return False
+
+
+def pageFilter():
+    """
+    :return: PageFilter with the rules for the current options.
+    """
+    rules = [('namespace', namespaceRule)]
+    if options.skipTitle:
+        rules.append(('title', titleRule))
+    rules.append(('Seznam/Rozcestnik', unwantedRule))
+    return PageFilter(rules)
+### MODIFIED_END
 
 
 def get_url(uid):
@@ -356,6 +454,25 @@ def ignoreTag(tag):
     right = re.compile(r'</\s*%s>' % tag, re.IGNORECASE)
     options.ignored_tag_patterns.append((left, right))
 
+### MODIFIED_START - fused span removal
+# Match the start of an HTML comment or of a tag, with the name of the tag
+# (all the spans dropped by Extractor.clean() start here)
+tagStart = re.compile(r'<(?:!--|\s*/?\s*(\w+))')
+
+# Tag in the source of the tag patterns below and of ignoreTag(), dropElements()
+patternTag = re.compile(r'<(?:\\s\*)?(?:/(?:\\s\*)?)?(\w+)'
+                        r'(?:>|\\b(?:\.\*\?|\[\^>\]\*/\\s\*|\[\^>/\]\*)>)$')
+
+# Tag names compared by their lowercase form
+asciiTagName = re.compile(r'[A-Za-z0-9_]+$')
+
+# Patterns of the discarded elements (options.discardElements)
+discardPatterns = {}
+
+# Lowercase tag of each pattern tried by dropElements(), None: not a tag pattern
+patternTags = {}
+### MODIFIED_END
+
 # Match selfClosing HTML tags
 selfClosing_tag_patterns = [
     re.compile(r'<\s*%s\b[^>]*/\s*>' % tag, re.DOTALL | re.IGNORECASE) for tag in selfClosingTags
@@ -396,6 +513,15 @@ class Template(list):
     A Template is a list of TemplateText or TemplateArgs
     """
 
+    ### MODIFIED_START - shared parsed templates, compiled templates
+    # no __dict__ in the (many) parsed templates of each extract process
+    __slots__ = ('compiled',)
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self.compiled = None  # see expand()
+    ### MODIFIED_END
+
     @classmethod
     def parse(cls, body):
         tpl = Template()
@@ -436,6 +562,38 @@ class Template(list):
 
         return ''.join([tpl.subst(params, extractor, depth) for tpl in self])
 
+    ### MODIFIED_START - compiled templates
+    def expand(self, params, extractor):
+        """
+        :return: the template with :param params: substituted and expanded,
+        the same as extractor.transform(self.subst(params, extractor)).
+        The brace structure of the template is found once (see CompiledTemplate),
+        its templates are expanded without scanning the substituted text again.
+        """
+        if self.compiled is None:
+            self.compiled = CompiledTemplate(self) if CompiledTemplate.compilable(self) else False
+        compiled = self.compiled
+        pieces = [tpl.subst(params, extractor, 0) for tpl in self]
+        if compiled:
+            values = [pieces[i] for i in compiled.args]
+            if not compiled.safe(values):
+                compiled = None
+        text = ''.join(pieces)
+        if not compiled or '<nowiki>' in text or not options.expand_templates or \
+                extractor.frame.depth >= extractor.maxTemplateRecursionLevels:
+            return extractor.transform(text)
+        res = []
+        for node in compiled.body:
+            if node.__class__ is int:
+                res.append(values[node])
+            elif node.__class__ is TemplateCall:
+                parts = [''.join([values[x] if x.__class__ is int else x for x in part]) for part in node.parts]
+                res.append(extractor.expandTemplate(None, parts, node.plain))
+            else:
+                res.append(node)
+        return ''.join(res)
+    ### MODIFIED_END
+
     def __str__(self):
         return ''.join([text_type(x) for x in self])
 
@@ -443,6 +601,10 @@ class Template(list):
 class TemplateText(text_type):
     """Fixed text of template"""
 
+    ### MODIFIED_START - shared parsed templates
+    __slots__ = ()
+    ### MODIFIED_END
+
 
     def subst(self, params, extractor, depth):
         return self
@@ -454,6 +616,11 @@ class TemplateArg(object):
     Has a name and a default value, both of which are Templates.
     """
 
+    ### MODIFIED_START - shared parsed templates, compiled templates
+    # plainName, plainDefault: text of name and default without templates (see plainText())
+    __slots__ = ('name', 'default', 'plainName', 'plainDefault')
+    ### MODIFIED_END
+
     def __init__(self, parameter):
         """
         :param parameter: the parts of a tplarg.
@@ -473,6 +640,10 @@ class TemplateArg(object):
             self.default = Template.parse(parts[1])
         else:
             self.default = None
+        ### MODIFIED_START - compiled templates
+        self.plainName = plainText(self.name)
+        self.plainDefault = plainText(self.default)
+        ### MODIFIED_END
 
     def __str__(self):
         if self.default:
@@ -487,20 +658,140 @@ class TemplateArg(object):
         Use :param extractor: to evaluate expressions for name and default.
         Limit substitution to the maximun :param depth:.
         """
+        ### MODIFIED_START - compiled templates
+        # plain name and default are their own expansions (unless over recursion limits)
+        plain = depth < extractor.maxParameterRecursionLevels and \
+                extractor.frame.depth < extractor.maxTemplateRecursionLevels
         # the parameter name itself might contain templates, e.g.:
         # appointe{{#if:{{{appointer14|}}}|r|d}}14|
-        paramName = self.name.subst(params, extractor, depth + 1)
-        paramName = extractor.transform(paramName)
+        if plain and self.plainName is not None:
+            paramName = self.plainName
+        else:
+            paramName = self.name.subst(params, extractor, depth + 1)
+            paramName = extractor.transform(paramName)
         res = ''
         if paramName in params:
             res = params[paramName]  # use parameter value specified in template invocation
         elif self.default:  # use the default value
-            defaultValue = self.default.subst(params, extractor, depth + 1)
-            res = extractor.transform(defaultValue)
+            if plain and self.plainDefault is not None:
+                res = self.plainDefault
+            else:
+                defaultValue = self.default.subst(params, extractor, depth + 1)
+                res = extractor.transform(defaultValue)
+        ### MODIFIED_END
         # logging.debug('subst arg %d %s -> %s' % (depth, paramName, res))
         return res
 
 
+### MODIFIED_START - compiled templates
+def plainText(template):
+    """
+    :return: the text of :param template: if it is its own expansion (no arguments,
+    templates and nowiki), else None.
+    """
+    if template is not None and len(template) == 1 and \
+            '{{' not in template[0] and '<nowiki>' not in template[0]:
+        return text_type(template[0])
+    return None
+
+
+class TemplateCall(object):
+    """
+    Template invocation in a CompiledTemplate.
+    """
+    __slots__ = ('parts', 'plain')
+
+    def __init__(self, parts, plain):
+        """
+        :param parts: list of parts (see splitParts()), each a list of texts and indexes of arguments.
+        :param plain: indexes of parts without templates.
+        """
+        self.parts = parts
+        self.plain = plain
+
+
+class CompiledTemplate(object):
+    """
+    Brace structure of a Template, found once in its skeleton - the template with
+    each argument replaced by a placeholder: body is a list of texts, indexes of
+    arguments (in args) and TemplateCalls.
+    The substituted template has the same structure, if the values of the arguments
+    do not add braces, brackets or pipes to it (see safe()).
+    """
+    __slots__ = ('body', 'args', 'inCall', 'neighbours')
+
+    placeholder = '\x00'
+
+    # link without pipes, brackets do not change the structure around it
+    linksRE = re.compile(r'[^][{}|]*(?:\[\[[^][{}|]*\]\][^][{}|]*)*$')
+
+    @classmethod
+    def compilable(cls, template):
+        return not any(cls.placeholder in item for item in template if isinstance(item, TemplateText))
+
+    def __init__(self, template):
+        # positions of the arguments in the template
+        self.args = [i for i, item in enumerate(template) if isinstance(item, TemplateArg)]
+        skeleton = ''.join([self.placeholder if isinstance(item, TemplateArg) else item for item in template])
+        # positions of the placeholders in the skeleton
+        positions = [i for i, c in enumerate(skeleton) if c == self.placeholder]
+        self.inCall = [False] * len(positions)
+        # characters around each placeholder
+        self.neighbours = [(skeleton[i - 1:i], skeleton[i + 1:i + 2]) for i in positions]
+
+        def pieces(start, end):
+            """Texts and argument indexes of skeleton[start:end]."""
+            res = []
+            arg = bisect_left(positions, start)
+            for text in skeleton[start:end].split(self.placeholder):
+                if text:
+                    res.append(text)
+                res.append(arg)
+                arg += 1
+            res.pop()  # no placeholder after the last text
+            return res
+
+        self.body = []
+        cur = 0
+        index = DelimiterIndex(skeleton)
+        for s, e in findMatchingBraces(skeleton, 2, index):
+            self.body.extend(pieces(cur, s))
+            parts = []
+            plain = set()
+            start = s + 2
+            for i, part in enumerate(splitParts(skeleton[s + 2:e - 2], index.window(s + 2, e - 2))):
+                parts.append(pieces(start, start + len(part)))
+                if '{{' not in part:
+                    plain.add(i)
+                start += len(part) + 1
+            for arg in range(bisect_left(positions, s), bisect_left(positions, e)):
+                self.inCall[arg] = True
+            self.body.append(TemplateCall(parts, plain))
+            cur = e
+        self.body.extend(pieces(cur, len(skeleton)))
+
+    def safe(self, values):
+        """
+        :param values: values of the arguments.
+        :return: whether the substituted template has the structure of the skeleton.
+        """
+        placeholder = self.placeholder
+        for value, inCall, (left, right) in zip(values, self.inCall, self.neighbours):
+            if '{' in value or '}' in value:
+                return False
+            # runs of braces or brackets joined or extended
+            if value:
+                if (value[0] in '[]' and left in (value[0], placeholder)) or \
+                        (value[-1] in '[]' and right in (value[-1], placeholder)):
+                    return False
+            elif left == placeholder or right == placeholder or (left == right and left in '{}[]'):
+                return False
+            if inCall and ('|' in value or (('[' in value or ']' in value) and not self.linksRE.match(value))):
+                return False
+        return True
+### MODIFIED_END
+
+
 class Frame(object):
 
     def __init__(self, title='', args=[], prev=None):
@@ -551,6 +842,11 @@ class Extractor(object):
         self.recursion_exceeded_2_errs = 0  # template recursion within expandTemplate()
         self.recursion_exceeded_3_errs = 0  # parameter recursion
         self.template_title_errs = 0
+        self.images = []  # paths of images/files referenced by the page, see imagePath()
+        ### MODIFIED_START - template expansion cache
+        # expansion used magic words of the page or frames of the callers (see ExpansionCache)
+        self.pageDependent = False
+        ### MODIFIED_END
 
     def write_output(self, out, text):
         """
@@ -634,6 +930,11 @@ class Extractor(object):
         self.magicWords['CURRENTTIME'] = time.strftime('%H:%M:%S')
         text = self.text
         self.text = ''          # save memory
+        ### MODIFIED_START - image/file references of pages
+        # template parameters before expansion (infoboxes), links after it
+        # (tables with the links are dropped in wiki2text())
+        if options.images_file:
+            images = findImageParams(text)
         #
         # @see https://doc.wikimedia.org/mediawiki-core/master/php/classParser.html
         # This does the equivalent of internalParse():
@@ -642,6 +943,12 @@ class Extractor(object):
         # $text = $frame->expand( $dom );
         #
         text = self.transform(text)
+        if options.images_file:
+            images += findImageLinks(text)
+            for path in map(imagePath, images):
+                if path not in self.images:
+                    self.images.append(path)
+        ### MODIFIED_END
         text = self.wiki2text(text)
         text = compact(self.clean(text))
         text = [title_str] + text
@@ -748,30 +1055,10 @@ class Extractor(object):
         Removes irrelevant parts from :param: text.
         """
 
-        # Collect spans
-        spans = []
-        # Drop HTML comments
-        for m in comment.finditer(text):
-            spans.append((m.start(), m.end()))
-
-        # Drop self-closing tags
-        for pattern in selfClosing_tag_patterns:
-            for m in pattern.finditer(text):
-                spans.append((m.start(), m.end()))
-
-        # Drop ignored tags
-        for left, right in options.ignored_tag_patterns:
-            for m in left.finditer(text):
-                spans.append((m.start(), m.end()))
-            for m in right.finditer(text):
-                spans.append((m.start(), m.end()))
-
-        # Bulk remove all spans
-        text = dropSpans(spans, text)
-
-        # Drop discarded elements
-        for tag in options.discardElements:
-            text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+        ### MODIFIED_START - fused span removal
+        # Drop HTML comments, self-closing, ignored tags and discarded elements
+        text = dropElements(text)
+        ### MODIFIED_END
 
         if not options.toHTML:
             # Turn into text what is left (&amp;nbsp;) and <syntaxhighlight>
@@ -849,17 +1136,29 @@ class Extractor(object):
 
         # logging.debug('%*s<expand', self.frame.depth, '')
 
+        ### MODIFIED_START - delimiter index
+        if '{{' not in wikitext:
+            return wikitext
         cur = 0
+        index = DelimiterIndex(wikitext)
         # look for matching {{...}}
-        for s, e in findMatchingBraces(wikitext, 2):
-            res += wikitext[cur:s] + self.expandTemplate(wikitext[s + 2:e - 2])
+        for s, e in findMatchingBraces(wikitext, 2, index):
+            res += wikitext[cur:s] + self.expandTemplate(wikitext[s + 2:e - 2],
+                                                         index=index.window(s + 2, e - 2))
             cur = e
+        ### MODIFIED_END
         # leftover
         res += wikitext[cur:]
         # logging.debug('%*sexpand> %s', self.frame.depth, '', res)
         return res
 
 
+    ### MODIFIED_START - template expansion cache
+    def errors(self):
+        return (self.template_title_errs + self.recursion_exceeded_1_errs +
+                self.recursion_exceeded_2_errs + self.recursion_exceeded_3_errs)
+    ### MODIFIED_END
+
     def templateParams(self, parameters):
         """
         Build a dictionary with positional or name key to expanded parameters.
@@ -929,9 +1228,12 @@ class Extractor(object):
         return templateParams
 
 
-    def expandTemplate(self, body):
+    def expandTemplate(self, body, parts=None, plain=(), index=None):
         """Expands template invocation.
         :param body: the parts of a template.
+        :param parts: body split by splitParts(), when body is None (see Template.expand()).
+        :param plain: indexes of parts without templates, they are not expanded.
+        :param index: DelimiterIndex of body (see expand()).
 
         :see http://meta.wikimedia.org/wiki/Help:Expansion for an explanation
         of the process.
@@ -979,11 +1281,17 @@ class Extractor(object):
             # logging.debug('%*sEXPAND> %s', self.frame.depth, '', body)
             return ''
 
-        logging.debug('%*sEXPAND %s', self.frame.depth, '', body)
-        parts = splitParts(body)
+        ### MODIFIED_START - compiled templates
+        if parts is None:
+            logging.debug('%*sEXPAND %s', self.frame.depth, '', body)
+            parts = splitParts(body, index)
+        else:
+            logging.debug('%*sEXPAND %s', self.frame.depth, '', '|'.join(parts))
         # title is the portion before the first |
         title = parts[0].strip()
-        title = self.expand(title)
+        if 0 not in plain:
+            title = self.expand(title)
+        ### MODIFIED_END
 
         # SUBST
         # Apply the template tag to parameters without
@@ -997,6 +1305,10 @@ class Extractor(object):
 
         if title in self.magicWords.values:
             ret = self.magicWords[title]
+            ### MODIFIED_START - template expansion cache
+            if title != '!':
+                self.pageDependent = True
+            ### MODIFIED_END
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, ret)
             return ret
 
@@ -1018,7 +1330,14 @@ class Extractor(object):
             funct = title[:colon]
             parts[0] = title[colon + 1:].strip()  # side-effect (parts[0] not used later)
             # arguments after first are not evaluated
+            ### MODIFIED_START - template profiler
+            profile = options.templateProfile
+            if profile is not None:
+                profile.enter()
             ret = callParserFunction(funct, parts, self)
+            if profile is not None:
+                profile.leave(funct.lower(), self.frame.depth, ret, self.title)
+            ### MODIFIED_END
             logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', funct, ret)
             return ret
 
@@ -1083,30 +1402,237 @@ class Extractor(object):
             # Evaluate parameters, since they may contain templates, including
             # the symbol "=".
             # {{#ifexpr: {{{1}}} = 1 }}
-            params = [self.transform(p) for p in params]
+            ### MODIFIED_START - compiled templates
+            params = [p if i in plain else self.transform(p) for i, p in enumerate(params, 1)]
+            ### MODIFIED_END
 
         # build a dict of name-values for the parameter values
         params = self.templateParams(params)
 
+        ### MODIFIED_START - template expansion cache
+        # recursion limits depend on the depth of the frame
+        cache = options.expansionCache
+        if cache is not None:
+            key = (title, subst, self.frame.depth, tuple(sorted(params.items())))
+            value = cache.get(key)
+            if value is not None:
+                ### MODIFIED_START - template profiler
+                if options.templateProfile is not None:
+                    options.templateProfile.cached(title, self.frame.depth)
+                ### MODIFIED_END
+                return value
+            pageDependent = self.pageDependent
+            self.pageDependent = False
+            errs = self.errors()
+        ### MODIFIED_END
+
         # Perform parameter substitution.
         # Extend frame before subst, since there may be recursion in default
         # parameter value, e.g. {{OTRS|celebrative|date=April 2015}} in article
         # 21637542 in enwiki.
+        ### MODIFIED_START - template profiler
+        profile = options.templateProfile
+        if profile is not None:
+            profile.enter()
+        ### MODIFIED_END
         self.frame = self.frame.push(title, params)
-        instantiated = template.subst(params, self)
-        value = self.transform(instantiated)
+        ### MODIFIED_START - compiled templates
+        value = template.expand(params, self)
+        ### MODIFIED_END
         self.frame = self.frame.pop()
+        ### MODIFIED_START - template profiler
+        if profile is not None:
+            profile.leave(title, self.frame.depth, value, self.title)
+        ### MODIFIED_END
+        ### MODIFIED_START - template expansion cache
+        if cache is not None:
+            # expansions with errors are not cached to count (and report) them again
+            if self.pageDependent or self.errors() != errs:
+                cache.uncached += 1
+            else:
+                cache.put(key, value)
+            self.pageDependent = self.pageDependent or pageDependent
+        ### MODIFIED_END
         logging.debug('%*s<EXPAND %s %s', self.frame.depth, '', title, value)
         return value
 
 
+### MODIFIED_START - template expansion cache
+class ExpansionCache(object):
+    """
+    Expansions of templates by their title and expanded parameters (and the
+    depth of the frame). When there are more than size of them, the least
+    recently used ones are evicted. Expansions using magic words of the page
+    (e.g. PAGENAME) or frames of the callers (#invoke) are not cached.
+    Each extract process has its own cache.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.expansions = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.uncached = 0
+
+    def get(self, key):
+        value = self.expansions.pop(key, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.expansions[key] = value  # the most recently used one
+        return value
+
+    def put(self, key, value):
+        self.expansions[key] = value
+        if len(self.expansions) > self.size:
+            self.expansions.popitem(last=False)
+            self.evictions += 1
+
+    def report(self, process):
+        logging.info("Template expansion cache of process %d: %d hits, %d misses, %d evictions, %d not cached",
+                     process, self.hits, self.misses, self.evictions, self.uncached)
+### MODIFIED_END
+
+
+### MODIFIED_START - template profiler
+class TemplateProfile(object):
+    """
+    Expansions of templates and parser functions (--profile_templates): their
+    calls, cache hits, cumulative and self time and maximum depth of the frame,
+    the largest expansions and the slowest pages.
+    Each extract process keeps its own profile and sends it to the reduce
+    process at the end, which merges them and writes the report.
+    """
+
+    top = 100  # length of the lists of the largest expansions and slowest pages
+
+    def __init__(self):
+        self.templates = {}  # title -> [calls, cache hits, cumulative time, self time, max depth]
+        self.largest = []    # heap of (length, title, page title)
+        self.slowest = []    # heap of (time, page id, page title)
+        self.running = []    # [start, time of nested expansions] of the running expansions
+        self.pageStart = None
+
+    def stats(self, title):
+        stats = self.templates.get(title)
+        if stats is None:
+            stats = self.templates[title] = [0, 0, 0.0, 0.0, 0]
+        return stats
+
+    def push(self, heap, item):
+        if len(heap) < self.top:
+            heapq.heappush(heap, item)
+        elif item > heap[0]:
+            heapq.heapreplace(heap, item)
+
+    def enter(self):
+        self.running.append([default_timer(), 0.0])
+
+    def leave(self, title, depth, value, page):
+        start, nested = self.running.pop()
+        elapsed = default_timer() - start
+        if self.running:
+            self.running[-1][1] += elapsed
+        stats = self.stats(title)
+        stats[0] += 1
+        stats[2] += elapsed
+        stats[3] += elapsed - nested
+        stats[4] = max(stats[4], depth)
+        self.push(self.largest, (len(value), title, page))
+
+    def cached(self, title, depth):
+        stats = self.stats(title)
+        stats[0] += 1
+        stats[1] += 1
+        stats[4] = max(stats[4], depth)
+
+    def startPage(self):
+        self.running = []  # left over by an exception
+        self.pageStart = default_timer()
+
+    def endPage(self, id, title):
+        self.push(self.slowest, (default_timer() - self.pageStart, id, title))
+
+    def merge(self, other):
+        for title, (calls, hits, cumulative, own, depth) in other.templates.items():
+            stats = self.stats(title)
+            stats[0] += calls
+            stats[1] += hits
+            stats[2] += cumulative
+            stats[3] += own
+            stats[4] = max(stats[4], depth)
+        for item in other.largest:
+            self.push(self.largest, item)
+        for item in other.slowest:
+            self.push(self.slowest, item)
+
+    def write(self, path):
+        """Writes the report, templates by their self time."""
+        with codecs.open(path, 'w', 'utf-8') as file:
+            file.write('# template\tcalls\tcache hits\tcumulative time (s)\tself time (s)\tmax depth\n')
+            for title, stats in sorted(self.templates.items(), key=lambda item: (-item[1][3], item[0])):
+                file.write('%s\t%d\t%d\t%.3f\t%.3f\t%d\n' % ((title,) + tuple(stats)))
+            file.write('\n# largest expansions: length\ttemplate\tpage\n')
+            for item in sorted(self.largest, reverse=True):
+                file.write('%d\t%s\t%s\n' % item)
+            file.write('\n# slowest pages: time (s)\tid\ttitle\n')
+            for item in sorted(self.slowest, reverse=True):
+                file.write('%.3f\t%s\t%s\n' % item)
+        logging.info("Template profile of %d templates written to %s", len(self.templates), path)
+### MODIFIED_END
+
+
 # ----------------------------------------------------------------------
 # parameter handling
 
+### MODIFIED_START - delimiter index
+# runs of two or more equal braces or brackets
+delimiterRE = re.compile(r'([{}\[\]])\1+')
+
+
+class DelimiterIndex(object):
+    """
+    Runs of {{, }}, [[ and ]] in a text, found in a single pass over it.
+    findMatchingBraces(), splitParts() and findBalanced() walk the runs
+    instead of searching the text for the next delimiter.
+    """
+    __slots__ = ('runs',)
+
+    def __init__(self, text, runs=None):
+        """
+        :param runs: list of (start, end, char) of the runs, found in text if None.
+        """
+        if runs is None:
+            runs = [(m.start(), m.end(), m.group(1)) for m in delimiterRE.finditer(text)]
+        self.runs = runs
+
+    def window(self, begin, end):
+        """
+        :return: the index of text[begin:end], without scanning it again.
+        """
+        runs = self.runs
+        # the runs do not overlap, a run before begin may reach into the window
+        lo = bisect_left(runs, (begin,))
+        if lo and runs[lo - 1][1] > begin:
+            lo -= 1
+        hi = bisect_left(runs, (end,), lo)
+        window = []
+        # cut the runs at the edges of the window
+        for s, e, brac in runs[lo:hi]:
+            s = max(s, begin) - begin
+            e = min(e, end) - begin
+            if e - s >= 2:
+                window.append((s, e, brac))
+        return DelimiterIndex(None, window)
+### MODIFIED_END
+
 
-def splitParts(paramsList):
+def splitParts(paramsList, index=None):
     """
     :param paramsList: the parts of a template or tplarg.
+    :param index: DelimiterIndex of paramsList, built if not given.
 
     Split template parameters at the separator "|".
     separator "=".
@@ -1141,45 +1667,31 @@ def splitParts(paramsList):
     # and tpl parameters like:
     #    ||[[Category:People|{{#if:A|A|{{PAGENAME}}}}]]
 
+    ### MODIFIED_START - delimiter index
+    # split at the separators outside of the spans, slicing the parameters
+    # out of paramsList instead of concatenating them piece by piece
     sep = '|'
     parameters = []
-    cur = 0
-
-    for s, e in findMatchingBraces(paramsList):
-        par = paramsList[cur:s].split(sep)
-        if par:
-            if parameters:
-                # portion before | belongs to previous parameter
-                parameters[-1] += par[0]
-                if len(par) > 1:
-                    # rest are new parameters
-                    parameters.extend(par[1:])
-            else:
-                parameters = par
-        elif not parameters:
-            parameters = ['']  # create first param
-        # add span to last previous parameter
-        parameters[-1] += paramsList[s:e]
+    start = cur = 0
+    end = len(paramsList)
+    for s, e in chain(findMatchingBraces(paramsList, 0, index), [(end, end)]):
+        pos = paramsList.find(sep, cur, s)
+        while pos >= 0:
+            parameters.append(paramsList[start:pos])
+            start = pos + 1
+            pos = paramsList.find(sep, start, s)
         cur = e
-    # leftover
-    par = paramsList[cur:].split(sep)
-    if par:
-        if parameters:
-            # portion before | belongs to previous parameter
-            parameters[-1] += par[0]
-            if len(par) > 1:
-                # rest are new parameters
-                parameters.extend(par[1:])
-        else:
-            parameters = par
+    parameters.append(paramsList[start:])
+    ### MODIFIED_END
 
     # logging.debug('splitParts %s %s\nparams: %s', sep, paramsList, text_type(parameters))
     return parameters
 
 
-def findMatchingBraces(text, ldelim=0):
+def findMatchingBraces(text, ldelim=0, index=None):
     """
     :param ldelim: number of braces to match. 0 means match [[]], {{}} and {{{}}}.
+    :param index: DelimiterIndex of text, built if not given.
     """
     # Parsing is done with respect to pairs of double braces {{..}} delimiting
     # a template, and pairs of triple braces {{{..}}} delimiting a tplarg.
@@ -1216,31 +1728,39 @@ def findMatchingBraces(text, ldelim=0):
     # as well as expressions with stray }:
     #   {{{link|{{ucfirst:{{{1}}}}}} interchange}}}
 
+    ### MODIFIED_START - delimiter index
+    # The runs of braces and brackets are taken from the index one after
+    # another, each of them is visited once.
+    if index is None:
+        index = DelimiterIndex(text)
     if ldelim:  # 2-3
-        reOpen = re.compile('[{]{%d,}' % ldelim)  # at least ldelim
-        reNext = re.compile('[{]{2,}|}{2,}')  # at least 2
+        runs = [run for run in index.runs if run[2] in '{}']
+        opening = '{'
     else:
-        reOpen = re.compile('{{2,}|\[{2,}')
-        reNext = re.compile('{{2,}|}{2,}|\[{2,}|]{2,}')  # at least 2
+        runs = index.runs
+        opening = '{['
+    minOpen = ldelim or 2  # at least ldelim, at least 2
+    count = len(runs)
 
-    cur = 0
+    i = 0
     while True:
-        m1 = reOpen.search(text, cur)
-        if not m1:
+        while i < count and (runs[i][2] not in opening or runs[i][1] - runs[i][0] < minOpen):
+            i += 1
+        if i == count:
             return
-        lmatch = m1.end() - m1.start()
-        if m1.group()[0] == '{':
+        start, end, brac = runs[i]
+        i += 1
+        lmatch = end - start
+        if brac == '{':
             stack = [lmatch]  # stack of opening braces lengths
         else:
             stack = [-lmatch]  # negative means [
-        end = m1.end()
         while True:
-            m2 = reNext.search(text, end)
-            if not m2:
+            if i == count:
                 return  # unbalanced
-            end = m2.end()
-            brac = m2.group()[0]
-            lmatch = m2.end() - m2.start()
+            s, end, brac = runs[i]
+            i += 1
+            lmatch = end - s
 
             if brac == '{':
                 stack.append(lmatch)
@@ -1258,13 +1778,11 @@ def findMatchingBraces(text, ldelim=0):
                         stack.append(openCount - lmatch)
                         break
                 if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
+                    yield start, end - lmatch
                     break
                 elif len(stack) == 1 and 0 < stack[0] < ldelim:
                     # ambiguous {{{{{ }}} }}
-                    #yield m1.start() + stack[0], end
-                    cur = end
+                    #yield start + stack[0], end
                     break
             elif brac == '[':  # [[
                 stack.append(-lmatch)
@@ -1280,21 +1798,41 @@ def findMatchingBraces(text, ldelim=0):
                         stack.append(lmatch - openCount)
                         break
                 if not stack:
-                    yield m1.start(), end - lmatch
-                    cur = end
+                    yield start, end - lmatch
                     break
                 # unmatched ]] are discarded
-                cur = end
+    ### MODIFIED_END
 
 
-def findBalanced(text, openDelim=['[['], closeDelim=[']]']):
+def findBalanced(text, openDelim=['[['], closeDelim=[']]'], index=None):
     """
     Assuming that text contains a properly balanced expression using
     :param openDelim: as opening delimiters and
     :param closeDelim: as closing delimiters.
+    :param index: DelimiterIndex of text, used for the default delimiters.
     :return: an iterator producing pairs (start, end) of start and end
     positions in text containing a balanced expression.
     """
+    ### MODIFIED_START - delimiter index
+    if openDelim == ['[['] and closeDelim == [']]']:
+        # a run of n brackets is n // 2 delimiters
+        if index is None:
+            index = DelimiterIndex(text)
+        depth = 0
+        for s, e, brac in index.runs:
+            if brac == '[':
+                if not depth:
+                    start = s
+                depth += (e - s) // 2
+            elif brac == ']' and depth:
+                closing = (e - s) // 2
+                if closing < depth:
+                    depth -= closing
+                else:
+                    yield start, s + 2 * depth
+                    depth = 0
+        return
+    ### MODIFIED_END
     openPat = '|'.join([re.escape(x) for x in openDelim])
     # pattern for delimiters expected after each opening delimiter
     afterPat = {o: re.compile(openPat + '|' + c, re.DOTALL) for o, c in zip(openDelim, closeDelim)}
@@ -1727,48 +2265,309 @@ def normalizeNamespace(ns):
 # https://github.com/Wikia/app/blob/dev/extensions/ParserFunctions/ParserFunctions_body.php
 
 
-class Infix:
-    """Infix operators.
-    The calling sequence for the infix is:
-      x |op| y
-    """
+### MODIFIED_START - expression evaluator
+# {{#expr:}} and {{#ifexpr:}} like Expr.php of Extension:ParserFunctions.
+# An expression is compiled into postfix order once (see compileExpr()), all
+# numbers are floats, so every operation takes constant time, and stacks are
+# limited like in Expr.php.
+
+maxExprStack = 100
+
+# compiled expressions, messages of invalid ones, cleared when full
+exprCache = {}
+maxExprCache = 10000
+
+exprTokenRE = re.compile(r'\s*(?:([0-9.]+)|([A-Za-z]+)|(!=|<>|<=|>=|[-+*/^()=<>])|(\S))')
+exprNumberRE = re.compile(r'[0-9]*\.?[0-9]*')
+
+
+class ExprError(Exception):
+    pass
+
+
+def exprInt(x):
+    """(int) of PHP."""
+    return int(x) if not math.isinf(x) and not math.isnan(x) and abs(x) < 2 ** 63 else 0
 
-    def __init__(self, function):
-        self.function = function
 
-    def __ror__(self, other):
-        return Infix(lambda x, self=self, other=other: self.function(other, x))
+def exprDivide(x, y):
+    if not y:
+        raise ExprError('Division by zero.')
+    return x / y
+
+
+def exprMod(x, y):
+    x, y = exprInt(x), exprInt(y)
+    if not y:
+        raise ExprError('Division by zero.')
+    res = abs(x) % abs(y)
+    return -res if x < 0 else res
+
+
+def exprFmod(x, y):
+    if not y:
+        raise ExprError('Division by zero.')
+    try:
+        return math.fmod(x, y)
+    except ValueError:          # infinite x
+        return float('nan')
+
+
+def exprPow(x, y):
+    try:
+        res = math.pow(x, y)
+    except OverflowError:
+        res = float('-inf') if x < 0 and y % 2 == 1 else float('inf')
+    except ValueError:
+        if x:
+            raise ExprError('In ^: result is not a number.')
+        res = float('inf')  # 0 ^ negative
+    if math.isnan(res):
+        raise ExprError('In ^: result is not a number.')
+    return res
+
 
-    def __or__(self, other):
-        return self.function(other)
+def exprRound(x, places):
+    """round() of PHP: halves away from zero, after rounding to 15 digits."""
+    places = max(-308, min(308, exprInt(places)))
+    factor = 10.0 ** abs(places)
+    scaled = x * factor if places >= 0 else x / factor
+    if math.isinf(scaled) or math.isnan(scaled):
+        return x
+    scaled = math.floor(abs(float('%.15g' % scaled)) + 0.5)
+    return math.copysign(scaled / factor if places >= 0 else scaled * factor, x)
 
-    def __rlshift__(self, other):
-        return Infix(lambda x, self=self, other=other: self.function(other, x))
 
-    def __rshift__(self, other):
-        return self.function(other)
+def exprFunction(name, function, inverse=False):
+    """A function of one argument, of inverse trigonometric ones in [-1, 1]."""
+    def apply(x):
+        if inverse and (x < -1 or x > 1):
+            raise ExprError('Invalid argument for %s: < -1 or > 1.' % name)
+        try:
+            return function(x)
+        except OverflowError:
+            return float('inf')
+        except ValueError:
+            return float('nan')
+    return apply
+
+
+def exprLn(x):
+    if x <= 0:
+        raise ExprError('Invalid argument for ln: <= 0.')
+    return math.log(x)
+
+
+def exprSqrt(x):
+    if x < 0 or math.isnan(x):
+        raise ExprError('In sqrt: result is not a number.')
+    return math.sqrt(x)
+
+
+def exprFloor(x, function=math.floor):
+    return float(function(x)) if not math.isinf(x) and not math.isnan(x) else x
+
+
+# name: (precedence, number of arguments, function), unary - and + are named
+# so that no word of an expression matches them
+exprOperators = {
+    'unary-': (10, 1, lambda x: -x),
+    'unary+': (10, 1, lambda x: x),
+    'not': (9, 1, lambda x: 0 if x else 1),
+    'sin': (9, 1, exprFunction('sin', math.sin)),
+    'cos': (9, 1, exprFunction('cos', math.cos)),
+    'tan': (9, 1, exprFunction('tan', math.tan)),
+    'asin': (9, 1, exprFunction('asin', math.asin, True)),
+    'acos': (9, 1, exprFunction('acos', math.acos, True)),
+    'atan': (9, 1, exprFunction('atan', math.atan)),
+    'exp': (9, 1, exprFunction('exp', math.exp)),
+    'ln': (9, 1, exprLn),
+    'abs': (9, 1, abs),
+    'floor': (9, 1, exprFloor),
+    'ceil': (9, 1, lambda x: exprFloor(x, math.ceil)),
+    'trunc': (9, 1, exprInt),
+    'sqrt': (9, 1, exprSqrt),
+    'e': (10, 2, lambda x, y: x * exprPow(10.0, y)),
+    '^': (8, 2, exprPow),
+    '*': (7, 2, lambda x, y: x * y),
+    '/': (7, 2, exprDivide),
+    'div': (7, 2, exprDivide),
+    'mod': (7, 2, exprMod),
+    'fmod': (7, 2, exprFmod),
+    '+': (6, 2, lambda x, y: x + y),
+    '-': (6, 2, lambda x, y: x - y),
+    'round': (5, 2, exprRound),
+    '=': (4, 2, lambda x, y: 1 if x == y else 0),
+    '<': (4, 2, lambda x, y: 1 if x < y else 0),
+    '>': (4, 2, lambda x, y: 1 if x > y else 0),
+    '<=': (4, 2, lambda x, y: 1 if x <= y else 0),
+    '>=': (4, 2, lambda x, y: 1 if x >= y else 0),
+    '!=': (4, 2, lambda x, y: 1 if x != y else 0),
+    '<>': (4, 2, lambda x, y: 1 if x != y else 0),
+    'and': (3, 2, lambda x, y: 1 if x and y else 0),
+    'or': (2, 2, lambda x, y: 1 if x or y else 0),
+}
 
-    def __call__(self, value1, value2):
-        return self.function(value1, value2)
+exprConstants = {'e': math.e, 'pi': math.pi}
 
 
-ROUND = Infix(lambda x, y: round(x, y))
+def compileExpr(expr):
+    """
+    :return: the expression in postfix order, a list of numbers and operators
+    (entries of exprOperators).
+    :raise ExprError: if expr is not a valid expression.
+    """
+    for entity, char in (('&lt;', '<'), ('&gt;', '>'), ('&minus;', '-'), ('−', '-')):
+        expr = expr.replace(entity, char)
+    code = []
+    operators = []  # names, '(' for open brackets
+    expecting = 'expression'
+
+    def pushOperator(name):
+        if len(operators) >= maxExprStack:
+            raise ExprError('Expression error: Stack exhausted.')
+        operators.append(name)
+
+    def popOperator():
+        code.append(exprOperators[operators.pop()])
+
+    for m in exprTokenRE.finditer(expr):
+        number, word, op, other = m.groups()
+        if number:
+            if expecting != 'expression':
+                raise ExprError('Expression error: Unexpected number.')
+            number = exprNumberRE.match(number).group()
+            code.append(float(number) if number.strip('.') else 0.0)
+            expecting = 'operator'
+            continue
+        elif word:
+            op = word.lower()
+            if op not in exprOperators and op != 'pi':
+                raise ExprError('Expression error: Unrecognized word "%s".' % op)
+            if expecting == 'expression' and op in exprConstants:
+                code.append(exprConstants[op])
+                expecting = 'operator'
+                continue
+            if op == 'pi':
+                raise ExprError('Expression error: Unexpected number.')
+            if exprOperators[op][1] == 1:
+                if expecting != 'expression':
+                    raise ExprError('Expression error: Unexpected %s operator.' % op)
+                pushOperator(op)
+                continue
+        elif other:
+            raise ExprError('Expression error: Unrecognized punctuation character "%s".' % other)
+        elif op == '(':
+            if expecting != 'expression':
+                raise ExprError('Expression error: Unexpected ( operator.')
+            pushOperator(op)
+            continue
+        elif op == ')':
+            if expecting == 'expression':
+                raise ExprError('Expression error: Unexpected closing bracket.')
+            while operators and operators[-1] != '(':
+                popOperator()
+            if not operators:
+                raise ExprError('Expression error: Unexpected closing bracket.')
+            operators.pop()
+            continue
+        elif op in '+-' and expecting == 'expression':
+            pushOperator('unary' + op)
+            continue
+        # binary operator
+        if expecting != 'operator':
+            raise ExprError('Expression error: Unexpected %s operator.' % op)
+        precedence = exprOperators[op][0]
+        while operators and operators[-1] != '(' and precedence <= exprOperators[operators[-1]][0]:
+            popOperator()
+        pushOperator(op)
+        expecting = 'expression'
+
+    if expecting == 'expression' and operators:
+        name = operators[-1]
+        if name == '(':
+            raise ExprError('Expression error: Unclosed bracket.')
+        raise ExprError('Expression error: Missing operand for %s.' %
+                        {'unary-': '-', 'unary+': '+'}.get(name, name))
+    while operators:
+        if operators[-1] == '(':
+            raise ExprError('Expression error: Unclosed bracket.')
+        popOperator()
+    return code
+
+
+def evalExpr(expr):
+    """
+    :return: the value of the expression, None if it is empty.
+    :raise ExprError: if expr is not a valid expression.
+    """
+    code = exprCache.get(expr)
+    if code is None:
+        try:
+            code = compileExpr(expr)
+        except ExprError as error:
+            # not the error itself: its traceback would keep the frames
+            # (and extractors) of all the pages raising it alive
+            code = error.args[0]
+        if len(exprCache) >= maxExprCache:
+            exprCache.clear()
+        exprCache[expr] = code
+    if not isinstance(code, list):
+        raise ExprError(code)
+    stack = []
+    for item in code:
+        if isinstance(item, float):
+            stack.append(item)
+        elif item[1] == 1:
+            stack[-1] = item[2](stack[-1])
+        else:
+            y = stack.pop()
+            stack[-1] = item[2](stack[-1], y)
+    return stack[-1] if stack else None
 
 
-from math import floor, ceil, pi, e, trunc, exp, log as ln, sin, cos, tan, asin, acos, atan
+def formatExpr(value):
+    """
+    :return: the number as PHP prints it, with 14 significant digits.
+    """
+    if not isinstance(value, float):
+        return text_type(value)
+    if math.isnan(value):
+        return 'NAN'
+    if math.isinf(value):
+        return 'INF' if value > 0 else '-INF'
+    sign = '-' if math.copysign(1, value) < 0 else ''
+    if not value:
+        return sign + '0'
+    mantissa, exponent = ('%.13e' % abs(value)).split('e')
+    digits = mantissa.replace('.', '').rstrip('0')
+    exponent = int(exponent)
+    if exponent < -4 or exponent >= 14:
+        return '%s%s.%sE%s%d' % (sign, digits[0], digits[1:] or '0', '-' if exponent < 0 else '+', abs(exponent))
+    if exponent < 0:
+        return '%s0.%s%s' % (sign, '0' * (-exponent - 1), digits)
+    fraction = digits[exponent + 1:]
+    return sign + digits[:exponent + 1].ljust(exponent + 1, '0') + ('.' + fraction if fraction else '')
 
 
 def sharp_expr(extr, expr):
-    """Tries converting a lua expr into a Python expr."""
+    """Evaluates a #expr expression."""
     try:
-        expr = extr.expand(expr)
-        expr = re.sub('(?<![!<>])=', '==', expr) # negative lookbehind
-        expr = re.sub('mod', '%', expr)          # no \b here
-        expr = re.sub('\bdiv\b', '/', expr)
-        expr = re.sub('\bround\b', '|ROUND|', expr)
-        return text_type(eval(expr))
-    except:
-        return '<span class="error">%s</span>' % expr
+        value = evalExpr(extr.expand(expr))
+    except ExprError as error:
+        return '<strong class="error">%s</strong>' % error
+    return '' if value is None else formatExpr(value)
+
+
+def sharp_ifexpr(extr, expr, valueIfTrue='', valueIfFalse='', *args):
+    try:
+        value = evalExpr(extr.expand(expr))
+    except ExprError as error:
+        return '<strong class="error">%s</strong>' % error
+    if value:
+        return extr.expand(valueIfTrue.strip())
+    return extr.expand(valueIfFalse.strip())
+### MODIFIED_END
 
 
 def sharp_if(extr, testValue, valueIfTrue, valueIfFalse=None, *args):
@@ -1876,7 +2675,7 @@ parserFunctions = {
 
     '#iferror': sharp_iferror,
 
-    '#ifexpr': lambda *args: '',  # not supported
+    '#ifexpr': sharp_ifexpr,
 
     '#ifexist': lambda extr, title, ifex, ifnex: extr.expand(ifnex), # assuming title is not present
 
@@ -1933,6 +2732,9 @@ def callParserFunction(functionName, args, extractor):
                 if not templateTitle:
                     logging.warn("Template with empty title")
                 params = None
+                ### MODIFIED_START - template expansion cache
+                extractor.pageDependent = True
+                ### MODIFIED_END
                 frame = extractor.frame
                 while frame:
                     if frame.title == templateTitle:
@@ -2021,6 +2823,184 @@ def define_template(title, page):
         options.templates[title] = text
 
 
+### MODIFIED_START - template store
+# ----------------------------------------------------------------------
+# Template store
+
+def encodeTemplate(template):
+    """
+    :return: parsed template as a list for marshal: str for TemplateText,
+    pair (name, default) for TemplateArg.
+    Stores of an older encoding are not used: increase TemplateStore.version
+    when it or the parsing of templates changes.
+    """
+    items = []
+    for item in template:
+        if isinstance(item, TemplateArg):
+            items.append((encodeTemplate(item.name),
+                          encodeTemplate(item.default) if item.default is not None else None))
+        else:
+            items.append(text_type(item))
+    return items
+
+
+# TemplateTexts by their text, shared by the decoded templates
+templateTexts = {}
+
+def decodeTemplate(items):
+    for i, item in enumerate(items):
+        if isinstance(item, tuple):
+            arg = TemplateArg.__new__(TemplateArg)  # already parsed
+            arg.name = decodeTemplate(item[0])
+            arg.default = decodeTemplate(item[1]) if item[1] is not None else None
+            arg.plainName = plainText(arg.name)
+            arg.plainDefault = plainText(arg.default)
+            items[i] = arg
+        else:
+            text = templateTexts.get(item)
+            if text is None:
+                text = templateTexts[item] = TemplateText(item)
+            items[i] = text
+    return Template(items)
+
+
+class TemplateStore(object):
+    """
+    Parsed templates of a template file, saved in a file mapped into memory.
+    It is used as options.templateCache: a template is unmarshalled when it is
+    first used, templates parsed later are kept in memory.
+    The file starts with a header (marshalled dict): size and mtime of the template file,
+    the Python version and the version of the store (for invalidation), namespaces,
+    redirects and the index (title -> offset and length of the template in the data
+    after the header).
+    """
+
+    magic = b'WXTSTORE'
+
+    # version of the parsed and encoded templates (Template.parse(), encodeTemplate())
+    version = 1
+
+    def __init__(self, path, header, offset):
+        self.path = path
+        self.header = header
+        self.offset = offset
+        self.index = header['index']
+        self.cache = {}
+        with open(path, 'rb') as file:
+            # slices of the map itself (Python 2 makes no memoryview of a mmap)
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def source(template_file):
+        stat = os.stat(template_file)
+        return (stat.st_size, stat.st_mtime, tuple(sys.version_info[:2]))
+
+    @classmethod
+    def open(cls, path, template_file):
+        """
+        :return: the store at :param path:, None if it does not exist or was not made from
+        the current :param template_file:.
+        """
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as file:
+            if file.read(len(cls.magic)) != cls.magic:
+                return None
+            size = int(file.readline())
+            header = marshal.loads(file.read(size))
+            if header['source'] != cls.source(template_file) or \
+               header.get('version') != cls.version:
+                return None
+            offset = file.tell()
+        return cls(path, header, offset)
+
+    @classmethod
+    def write(cls, path, template_file):
+        """
+        Parses options.templates and saves them with options.redirects to :param path:.
+        """
+        index = {}
+        data = []
+        offset = 0
+        for title, text in options.templates.items():
+            item = marshal.dumps(encodeTemplate(Template.parse(text)))
+            index[title] = (offset, len(item))
+            data.append(item)
+            offset += len(item)
+        header = marshal.dumps({'source': cls.source(template_file),
+                                'version': cls.version,
+                                'templateNamespace': options.templateNamespace,
+                                'moduleNamespace': options.moduleNamespace,
+                                'redirects': options.redirects,
+                                'index': index})
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as file:
+            file.write(cls.magic)
+            file.write(('%d\n' % len(header)).encode('ascii'))
+            file.write(header)
+            for item in data:
+                file.write(item)
+        getattr(os, 'replace', os.rename)(tmp, path)
+
+    def __contains__(self, title):
+        return title in self.cache or title in self.index
+
+    def __getitem__(self, title):
+        template = self.cache.get(title)
+        if template is None:
+            offset, length = self.index[title]
+            offset += self.offset
+            template = decodeTemplate(marshal.loads(self.data[offset:offset + length]))
+            self.cache[title] = template
+        return template
+
+    def __setitem__(self, title, template):
+        self.cache[title] = template
+
+    def __len__(self):
+        return len(set(self.index) | set(self.cache))
+
+    def __getstate__(self):
+        # the copy in another process maps the file again
+        return self.path, self.header, self.offset
+
+    def __setstate__(self, state):
+        self.__init__(*state)
+
+
+storeSuffix = '.store'
+
+def load_template_store(template_file):
+    """
+    Loads templates from :param template_file: using its store (template_file + '.store'),
+    which is made when it does not exist or the template file changed.
+    """
+    store_file = template_file + storeSuffix
+    store = TemplateStore.open(store_file, template_file)
+    if not store:
+        file = fileinput.FileInput(template_file, openhook=fileinput.hook_compressed)
+        load_templates(file)
+        file.close()
+        try:
+            TemplateStore.write(store_file, template_file)
+        except (IOError, OSError) as e:
+            logging.warn("Could not save template store %s: %s", store_file, e)
+            return
+        logging.info("Saved %d parsed templates to '%s'", len(options.templates), store_file)
+        store = TemplateStore.open(store_file, template_file)
+        options.templates = {}
+    else:
+        if not options.templateNamespace:
+            options.templateNamespace = store.header['templateNamespace']
+        if not options.moduleNamespace:
+            options.moduleNamespace = store.header['moduleNamespace']
+        options.templatePrefix = options.templateNamespace + ':'
+        options.modulePrefix = options.moduleNamespace + ':'
+        options.redirects.update(store.header['redirects'])
+    options.templateCache = store
+### MODIFIED_END
+
+
 # ----------------------------------------------------------------------
 
 def dropNested(text, openDelim, closeDelim):
@@ -2029,51 +3009,72 @@ def dropNested(text, openDelim, closeDelim):
     """
     openRE = re.compile(openDelim, re.IGNORECASE)
     closeRE = re.compile(closeDelim, re.IGNORECASE)
+    ### MODIFIED_START - fused span removal
+    def search(delimRE):
+        def find(pos):
+            m = delimRE.search(text, pos)
+            return m.span() if m else None
+        return find
+    spans = nestedSpans(search(openRE), search(closeRE))
+    if not spans:
+        return text
+    # collect text outside partitions
+    return dropSpans(spans, text)
+
+
+def nestedSpans(openSearch, closeSearch):
+    """
+    Partitions of nested expressions, as removed by dropNested().
+    :param openSearch: function returning the span (start, end) of the first
+    opening delimiter at or after a position, None if there is none.
+    :param closeSearch: the same for closing delimiters.
+    :return: list of spans.
+    """
     # partition text in separate blocks { } { }
     spans = []                  # pairs (s, e) for each partition
     nest = 0                    # nesting level
-    start = openRE.search(text, 0)
+    start = openSearch(0)
     if not start:
-        return text
-    end = closeRE.search(text, start.end())
+        return spans
+    end = closeSearch(start[1])
     next = start
     while end:
-        next = openRE.search(text, next.end())
+        next = openSearch(next[1])
         if not next:            # termination
             while nest:         # close all pending
                 nest -= 1
-                end0 = closeRE.search(text, end.end())
+                end0 = closeSearch(end[1])
                 if end0:
                     end = end0
                 else:
                     break
-            spans.append((start.start(), end.end()))
+            spans.append((start[0], end[1]))
             break
-        while end.end() < next.start():
+        while end[1] < next[0]:
             # { } {
             if nest:
                 nest -= 1
                 # try closing more
-                last = end.end()
-                end = closeRE.search(text, end.end())
+                last = end[1]
+                end = closeSearch(end[1])
                 if not end:     # unbalanced
                     if spans:
                         span = (spans[0][0], last)
                     else:
-                        span = (start.start(), last)
+                        span = (start[0], last)
                     spans = [span]
                     break
             else:
-                spans.append((start.start(), end.end()))
+                spans.append((start[0], end[1]))
                 # advance start, find next close
                 start = next
-                end = closeRE.search(text, next.end())
+                end = closeSearch(next[1])
                 break           # { }
         if next != start:
             # { { }
             nest += 1
-    # collect text outside partitions
-    return dropSpans(spans, text)
+    return spans
+    ### MODIFIED_END
 
 
 def dropSpans(spans, text):
@@ -2092,6 +3093,172 @@ def dropSpans(spans, text):
     return res
 
 
+### MODIFIED_START - fused span removal
+def dropElements(text):
+    """
+    Drops from :param text: HTML comments, self-closing tags, ignored tags
+    (options.ignored_tag_patterns) and discarded elements
+    (options.discardElements).
+    Finds the starts of comments and tags in one walk through the text, tries
+    each pattern only at the tags of its name and drops all the spans at once.
+    Elements are matched as if each pattern were applied to the text left by
+    the previous ones; when a dropped span follows an unclosed '<', what is
+    left of the text may join into a new tag, and the patterns are applied
+    one by one instead (dropElementsByTag()).
+    """
+    comments = []
+    tags = {}                   # lowercase name -> positions, None: other names
+    for m in tagStart.finditer(text):
+        name = m.group(1)
+        if name is None:
+            comments.append(m.start())
+        elif asciiTagName.match(name):
+            tags.setdefault(name.lower(), []).append(m.start())
+        else:
+            tags.setdefault(None, []).append(m.start())
+    if not comments and not tags:
+        return text
+
+    def positions(pattern):
+        if pattern not in patternTags:
+            m = patternTag.match(pattern.pattern)
+            patternTags[pattern] = m.group(1).lower() \
+                if m and asciiTagName.match(m.group(1)) else None
+        tag = patternTags[pattern]
+        if tag is None:
+            return None
+        found = tags.get(tag, [])
+        if None in tags:
+            found = sorted(found + tags[None])
+        return found
+
+    def matches(pattern, found):
+        # as pattern.finditer(text)
+        spans = []
+        last = 0
+        for pos in found:
+            if pos >= last:
+                m = pattern.match(text, pos)
+                if m:
+                    spans.append(m.span())
+                    last = m.end()
+        return spans
+
+    spans = matches(comment, comments)
+    for pattern in chain(selfClosing_tag_patterns,
+                         chain.from_iterable(options.ignored_tag_patterns)):
+        found = positions(pattern)
+        if found is None:
+            return dropElementsByTag(text)
+        if found:
+            spans.extend(matches(pattern, found))
+
+    # spans kept by dropSpans()
+    spans.sort()
+    dropped = []
+    offset = 0
+    for s, e in spans:
+        if offset <= s:
+            dropped.append((s, e))
+            offset = e
+    removed = list(dropped)     # disjoint sorted spans dropped so far
+
+    def kept(pos):
+        i = bisect_left(removed, (pos + 1,)) - 1
+        return i < 0 or removed[i][1] <= pos
+
+    def search(spans):
+        # as delimRE.search(text, pos) in dropNested()
+        def find(pos):
+            i = bisect_left(spans, (pos,))
+            return spans[i] if i < len(spans) else None
+        return find
+
+    for tag in options.discardElements:
+        if tag not in discardPatterns:
+            discardPatterns[tag] = (re.compile(r'<\s*%s\b[^>/]*>' % tag, re.IGNORECASE),
+                                    re.compile(r'<\s*/\s*%s>' % tag, re.IGNORECASE))
+        openRE, closeRE = discardPatterns[tag]
+        found = positions(openRE)
+        if found is None:
+            return dropElementsByTag(text)
+        # skip tags inside dropped spans
+        found = [pos for pos in found if kept(pos)]
+        if not found:
+            continue
+        opens = [m.span() for m in (openRE.match(text, pos) for pos in found) if m]
+        if not opens:
+            continue
+        closes = [m.span() for m in (closeRE.match(text, pos) for pos in found) if m]
+        # match in the positions of the text left by the previous patterns
+        ends = [e for s, e in removed]
+        shifts = [0]
+        for s, e in removed:
+            shifts.append(shifts[-1] + e - s)
+        for delims in (opens, closes):
+            for i, (s, e) in enumerate(delims):
+                shift = shifts[bisect_right(ends, s)]
+                delims[i] = (s - shift, e - shift, s, e)
+        starts = dict((s, s0) for s, e, s0, e0 in opens)
+        stops = dict((e, e0) for s, e, s0, e0 in closes)
+        nested = [(starts[s], stops[e])
+                  for s, e in nestedSpans(search(opens), search(closes))]
+        if nested:
+            dropped.extend(nested)
+            removed = mergeSpans(removed + nested)
+
+    for s, e in dropped:
+        if text.find('<', text.rfind('>', 0, s) + 1, s) >= 0:
+            return dropElementsByTag(text)
+    return dropSpans(removed, text)
+
+
+def mergeSpans(spans):
+    """
+    :return: sorted disjoint spans covering :param spans:.
+    """
+    merged = []
+    for s, e in sorted(spans):
+        if merged and s < merged[-1][1]:
+            if e > merged[-1][1]:
+                merged[-1] = (merged[-1][0], e)
+        else:
+            merged.append((s, e))
+    return merged
+
+
+def dropElementsByTag(text):
+    """
+    Drops the same as dropElements(), applying the patterns one by one.
+    """
+    # Collect spans
+    spans = []
+    # Drop HTML comments
+    for m in comment.finditer(text):
+        spans.append((m.start(), m.end()))
+
+    # Drop self-closing tags
+    for pattern in selfClosing_tag_patterns:
+        for m in pattern.finditer(text):
+            spans.append((m.start(), m.end()))
+
+    # Drop ignored tags
+    for left, right in options.ignored_tag_patterns:
+        for m in left.finditer(text):
+            spans.append((m.start(), m.end()))
+        for m in right.finditer(text):
+            spans.append((m.start(), m.end()))
+
+    # Bulk remove all spans
+    text = dropSpans(spans, text)
+
+    # Drop discarded elements
+    for tag in options.discardElements:
+        text = dropNested(text, r'<\s*%s\b[^>/]*>' % tag, r'<\s*/\s*%s>' % tag)
+    return text
+### MODIFIED_END
+
+
 # ----------------------------------------------------------------------
 # WikiLinks
 
@@ -2112,7 +3279,9 @@ def replaceInternalLinks(text):
     # triple closing ]]].
     cur = 0
     res = ''
-    for s, e in findBalanced(text):
+    ### MODIFIED_START - delimiter index
+    index = DelimiterIndex(text)
+    for s, e in findBalanced(text, index=index):
         m = tailRE.match(text, e)
         if m:
             trail = m.group(0)
@@ -2130,7 +3299,7 @@ def replaceInternalLinks(text):
             title = inner[:pipe].rstrip()
             # find last |
             curp = pipe + 1
-            for s1, e1 in findBalanced(inner):
+            for s1, e1 in findBalanced(inner, index=index.window(s + 2, e - 2)):
                 last = inner.rfind('|', curp, s1)
                 if last >= 0:
                     pipe = last  # advance
@@ -2138,6 +3307,7 @@ def replaceInternalLinks(text):
             label = inner[pipe + 1:].strip()
         res += text[cur:s] + makeInternalLink(title, label) + trail
         cur = end
+    ### MODIFIED_END
     return res + text[cur:]
 
 
@@ -2421,6 +3591,58 @@ def makeInternalLink(title, label):
         return label
 
 
+### MODIFIED_START - image/file references of pages
+# ----------------------------------------------------------------------
+# Images
+
+imageExtensions = r'jpe?g|png|gif|svg|tiff?|webp|xcf|pdf|djvu|ogg|og[av]|webm|mid|flac|wav'
+
+# template parameter with a file name, e.g. | obrázek = Praha.jpg (not an URL, file names have no '/')
+imageParamRE = re.compile(r'=[ \t]*([^][{}|=<>\n/]+?\.(?:%s))[ \t]*(?=\||}}|\n)' % imageExtensions, re.I)
+
+# <gallery> (still escaped), its lines are: File:Name.jpg|caption or just Name.jpg|caption
+galleryRE = re.compile(r'&lt;gallery(?:\s[^&]*)?&gt;(.*?)&lt;/gallery&gt;', re.S | re.I)
+galleryLineRE = re.compile(r'^[ \t]*([^|\n]+?\.(?:%s))[ \t]*(?:\||$)' % imageExtensions, re.M | re.I)
+
+
+def imageNamespacesRE():
+    return '|'.join(re.escape(ns) for ns in sorted(options.imageNamespaces))
+
+
+def findImageParams(text):
+    """
+    :param text: wikitext before template expansion.
+    :return: names of files in template parameters (e.g. images of infoboxes).
+    """
+    return imageParamRE.findall(text)
+
+
+def findImageLinks(text):
+    """
+    :param text: wikitext after template expansion.
+    :return: names of files from links [[File:Name.jpg|...]] and <gallery> elements.
+    """
+    names = re.findall(r'\[\[[ \t]*:?[ \t]*(?:%s)[ \t]*:[ \t]*([^][{}|<>\n]+?)[ \t]*(?=\||\]\])' % imageNamespacesRE(),
+                       text, re.I)
+    for m in galleryRE.finditer(text):
+        names += galleryLineRE.findall(m.group(1))
+    return names
+
+
+def imagePath(name):
+    """
+    :param name: name of a file, possibly with the File namespace and escaped.
+    :return: path of the file on upload.wikimedia.org in the scheme of the knowledge base,
+    wikimedia/commons/a/ab/Name.jpg, where a, ab are the first hex digits of md5 of the name.
+    """
+    name = unescape(unescape(name))  # xml escaping of the dump and entities in wikitext
+    name = re.sub(r'^(?:%s)[ \t]*:' % imageNamespacesRE(), '', name.strip(), flags=re.I)
+    name = ucfirst(re.sub(r'[\s_]+', '_', name).strip('_'))
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return 'wikimedia/commons/%s/%s/%s' % (digest[0], digest[:2], quote(name.encode('utf-8'), safe=";@$!*(),/~:"))
+
+### MODIFIED_END
+
 # ----------------------------------------------------------------------
 # External links
 
@@ -2743,7 +3965,9 @@ def load_templates(file, output_file=None):
 
     if output_file:
         output = codecs.open(output_file, 'wb', 'utf-8')
-    for page_count, page_data in enumerate(pages_from(file)):
+    ### MODIFIED_START - reader filters
+    for page_count, page_data in enumerate(pages_from(file, templateKeys)):
+    ### MODIFIED_END
         id, revid, title, ns, page = page_data
         if not output_file and (not options.templateNamespace or
                                 not options.moduleNamespace):  # do not know it yet
@@ -2778,12 +4002,39 @@ def load_templates(file, output_file=None):
         logging.info("Saved %d templates to '%s'", len(options.templates), output_file)
 
 
-def pages_from(input):
+### MODIFIED_START - byte level page scanner
+def read_chunks(input, lines=1000, chunk_size=1024 * 1024):
+    """
+    Reads binary files (see open_dump) by chunks, other input (e.g. fileinput) by lines joined
+    into chunks of bytes (str lines are encoded).
+    """
+    if isinstance(input, IOBase) and not isinstance(input, TextIOBase):
+        for chunk in iter(lambda: input.read(chunk_size), b''):
+            yield chunk
+        return
+    input = iter(input)
+    while True:
+        chunk = list(islice(input, lines))
+        if not chunk:
+            break
+        if isinstance(chunk[0], text_type):
+            yield ''.join(chunk).encode('utf-8')
+        else:
+            yield b''.join(chunk)
+
+
+def pages_from(input, namespaces=None, skipTitle=None, skipped=None):
     """
     Scans input extracting pages.
-    :return: (id, revid, title, namespace key, page), page is a list of lines.
+    Input is scanned as bytes with find(): tags are looked for only outside of <text>,
+    inside of it (where markup is escaped) just its end. The text of a page is decoded once.
+    :param namespaces: keys of namespaces of the pages to extract (None: all).
+    :param skipTitle: regex, pages with matching titles (as in the dump, escaped) are not extracted.
+    Other pages are skipped up to </page>, their text is not collected.
+    :param skipped: stats of PageFilter, where to count the skipped pages ('namespace', 'title').
+    :return: (id, revid, title, namespace key, page), page is a list with the text of the page.
     """
-    # we collect individual lines, since str.join() is significantly faster
+    # we collect pieces of text, since join() is significantly faster
     # than concatenation
     page = []
     id = None
@@ -2793,57 +4044,264 @@ def pages_from(input):
     inText = False
     redirect = False
     title = None
-    for line in input:
-        if not isinstance(line, text_type): line = line.decode('utf-8')
-        if '<' not in line:  # faster than doing re.search()
-            if inText:
-                page.append(line)
-            continue
-        m = tagRE.search(line)
-        if not m:
-            continue
-        tag = m.group(2)
-        if tag == 'page':
-            page = []
-            redirect = False
-        elif tag == 'id' and not id:
-            id = m.group(3)
-        elif tag == 'id' and id:
-            revid = m.group(3)
-        elif tag == 'title':
-            title = m.group(3)
-        elif tag == 'ns':
-            ns = m.group(3)
-        elif tag == 'redirect':
-            redirect = True
-        elif tag == 'text':
-            if m.lastindex == 3 and line[m.start(3)-2] == '/': # self closing
-                # <text xml:space="preserve" />
+    skip = False
+    buffer = b''
+    pos = 0
+    for chunk in read_chunks(input):
+        buffer = buffer[pos:] + chunk
+        pos = 0
+        while True:
+            if skip:
+                end = buffer.find(b'</page>', pos)
+                if end < 0:
+                    pos = max(pos, len(buffer) - 6)
+                    break
+                pos = end + 7
+                skip = False
+                id = None
+                revid = None
+                title = None
+                ns = '0'
+                page = []
                 continue
-            inText = True
-            line = line[m.start(3):m.end(3)]
-            page.append(line)
-            if m.lastindex == 4:  # open-close
+            if inText:
+                end = buffer.find(b'</text>', pos)
+                if end < 0:
+                    # the end of the buffer can be the beginning of </text>
+                    end = max(pos, len(buffer) - 6)
+                    page.append(buffer[pos:end])
+                    pos = end
+                    break
+                page.append(buffer[pos:end])
+                pos = end + 7
                 inText = False
-        elif tag == '/text':
-            if m.group(1):
-                page.append(m.group(1))
-            inText = False
-        elif inText:
-            page.append(line)
-        elif tag == '/page':
-            if id != last_id and not redirect:
-                yield (id, revid, title, ns, page)
-                last_id = id
-                ns = '0'
-            id = None
-            revid = None
-            title = None
-            page = []
+                continue
+            start = buffer.find(b'<', pos)
+            if start < 0:
+                pos = len(buffer)
+                break
+            end = buffer.find(b'>', start)
+            if end < 0:
+                pos = start     # incomplete tag, read more
+                break
+            tag = (buffer[start + 1:end].split(None, 1) or [b''])[0]
+            if tag == b'id' or tag == b'title' or tag == b'ns':
+                # value of the tag: up to the next tag
+                close = buffer.find(b'<', end + 1)
+                if close < 0:
+                    pos = start
+                    break
+                value = buffer[end + 1:close].decode('utf-8')
+                if tag == b'title':
+                    title = value
+                    skip = skipTitle is not None and skipTitle.search(title) is not None
+                    if skip and skipped is not None:
+                        skipped['title'][0] += 1
+                elif tag == b'ns':
+                    ns = value
+                    skip = namespaces is not None and ns not in namespaces
+                    if skip and skipped is not None:
+                        skipped['namespace'][0] += 1
+                elif not id:
+                    id = value
+                else:
+                    revid = value
+                pos = close
+                continue
+            pos = end + 1
+            if tag == b'page':
+                page = []
+                redirect = False
+            elif tag == b'redirect' or tag == b'redirect/':
+                redirect = True
+            elif tag == b'text' or tag == b'text/':
+                if buffer[end - 1:end] != b'/':     # not self closing <text xml:space="preserve" />
+                    inText = True
+            elif tag == b'/page':
+                if id != last_id and not redirect:
+                    yield (id, revid, title, ns, [b''.join(page).decode('utf-8')])
+                    last_id = id
+                    ns = '0'
+                id = None
+                revid = None
+                title = None
+                page = []
+### MODIFIED_END
+
+
+### MODIFIED_START - parallel bz2 decompression
+# ----------------------------------------------------------------------
+# Parallel bz2 reader
+
+# header of a bz2 stream (BZh and block size) is followed by the magic number of its first block
+bz2BlockMagic = b'1AY&SY'
+
+
+def decompress_streams(data):
+    """
+    :param data: one or more whole bz2 streams.
+    :return: decompressed data.
+    """
+    out = []
+    while data:
+        decompressor = bz2.BZ2Decompressor()
+        out.append(decompressor.decompress(data))
+        data = decompressor.unused_data
+        if not data and not getattr(decompressor, 'eof', True):
+            raise IOError("bz2 stream is not complete")
+    return b''.join(out)
+
 
+def last_stream_start(data):
+    """
+    :return: position of the last bz2 stream header in data (not at its beginning), -1 if there is none.
+    """
+    pos = data.rfind(bz2BlockMagic)
+    while pos > 4:
+        if data[pos - 4:pos - 1] == b'BZh' and data[pos - 1:pos] in b'123456789':
+            return pos - 4
+        pos = data.rfind(bz2BlockMagic, 0, pos)
+    return -1
+
+
+class ParallelBZ2Reader(object):
+    """
+    Iterates over lines (bytes, like fileinput.hook_compressed) of a bz2 file, decompressing it in several processes.
+    The file is split at starts of bz2 streams, so this speeds up multistream dumps
+    (pages-articles-multistream.xml.bz2) and files compressed by pbzip2/lbzip2.
+    Blocks of a single stream are not byte aligned, such file is decompressed sequentially.
+    """
+
+    # compressed bytes decompressed by one task
+    chunk_size = 4 * 1024 * 1024
+
+    def __init__(self, filename, process_count):
+        self.file = open(filename, 'rb')
+        self.process_count = process_count
+        self.pool = Pool(process_count)
+        self.lines = self.read_lines()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return next(self.lines)
 
+    next = __next__             # Python 2
+
+    def read_lines(self):
+        rest = b''
+        for data in self.read_blocks():
+            end = data.rfind(b'\n') + 1
+            if not end:
+                rest += data
+                continue
+            for line in BytesIO(rest + data[:end]):
+                yield line
+            rest = data[end:]
+        if rest:
+            yield rest
+
+    def read_blocks(self):
+        """
+        Generates decompressed data, in the order of the file.
+        """
+        pending = deque()       # decompression tasks in the order of the file
+        buffer = b''
+        while True:
+            data = self.file.read(self.chunk_size)
+            buffer += data
+            start = len(buffer) if not data else last_stream_start(buffer)
+            if start > 0:
+                pending.append(self.pool.apply_async(decompress_streams, (buffer[:start],)))
+                buffer = buffer[start:]
+                if len(pending) >= 2 * self.process_count:
+                    yield pending.popleft().get()
+            elif len(buffer) > 2 * self.chunk_size:
+                break           # single stream
+            if not data:
+                break
+        while pending:
+            yield pending.popleft().get()
+        if not buffer:
+            return
+
+        logging.info("No bz2 stream boundaries in %s, decompressing sequentially.", self.file.name)
+        decompressor = bz2.BZ2Decompressor()
+        while buffer:
+            yield decompressor.decompress(buffer)
+            if getattr(decompressor, 'eof', False) or decompressor.unused_data:     # next stream
+                buffer = decompressor.unused_data or self.file.read(self.chunk_size)
+                decompressor = bz2.BZ2Decompressor()
+            else:
+                buffer = self.file.read(self.chunk_size)
+
+    def close(self):
+        self.pool.terminate()
+        self.file.close()
+
+
+def open_dump(input_file, decompress_count=0):
+    """
+    :param decompress_count: number of processes decompressing a .bz2 file (0: sequentially, in this process).
+    """
+    # binary files, see read_chunks
+    if input_file.endswith('.bz2'):
+        if decompress_count > 0:
+            return ParallelBZ2Reader(input_file, decompress_count)
+        return bz2.BZ2File(input_file)
+    if input_file.endswith('.gz'):
+        return gzip.open(input_file, 'rb')
+    return open(input_file, 'rb')
+### MODIFIED_END
+
+
+### MODIFIED_START - multistream index
+def read_multistream_index(index_file, input_file):
+    """
+    :param index_file: index of a multistream dump (pages-articles-multistream-index.txt[.bz2]),
+        lines offset:page id:title.
+    :param input_file: the multistream dump.
+    :return: (offset, length) of the streams with pages, in the order of the file.
+        The stream before the first one holds <siteinfo>.
+    """
+    if index_file.endswith('.bz2'):
+        index = bz2.BZ2File(index_file)
+    else:
+        index = open(index_file, 'rb')
+    offsets = set()
+    for line in index:
+        offsets.add(int(line[:line.index(b':')]))
+    index.close()
+    offsets = sorted(offsets)
+    # the last stream of pages also holds the end of the dump (</mediawiki>)
+    offsets.append(os.path.getsize(input_file))
+    return [(offsets[i], offsets[i + 1] - offsets[i]) for i in range(len(offsets) - 1)]
+### MODIFIED_END
+
+
+### MODIFIED_START - shared parsed templates
+# temporary template stores made by process_dump()
+runStoreFiles = []
+
+def removeRunStores(function):
+    """
+    Removes the temporary template stores made by :param function: when it
+    returns, also when it fails.
+    """
+    def call(*args, **kwargs):
+        try:
+            return function(*args, **kwargs)
+        finally:
+            while runStoreFiles:
+                os.remove(runStoreFiles.pop())
+    return call
+
+
+@removeRunStores
+### MODIFIED_END
 def process_dump(input_file, template_file, out_file, file_size, file_compress,
-                 process_count):
+                 process_count, decompress_count=0, index_file=None):
     """
     :param input_file: name of the wikipedia dump file; '-' to read from stdin
     :param template_file: optional file with template definitions.
@@ -2851,12 +4309,25 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
     :param file_size: max size of each extracted file, or None for no max (one file)
     :param file_compress: whether to compress files with bzip.
     :param process_count: number of extraction processes to spawn.
+    :param decompress_count: number of processes decompressing a .bz2 dump.
+    :param index_file: index of a multistream dump - the extraction processes read its streams themselves.
     """
 
     if input_file == '-':
-        input = sys.stdin
+        ### MODIFIED_START - byte level page scanner
+        input = sys.stdin if PY2 else sys.stdin.buffer
+        ### MODIFIED_END
+    ### MODIFIED_START - multistream index
+    elif index_file:
+        # only the first stream (siteinfo) is read here
+        streams = read_multistream_index(index_file, input_file)
+        with open(input_file, 'rb') as file:
+            input = BytesIO(decompress_streams(file.read(streams[0][0])))
+    ### MODIFIED_END
     else:
-        input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+        ### MODIFIED_START - parallel bz2 decompression
+        input = open_dump(input_file, decompress_count)
+        ### MODIFIED_END
 
     # collect siteinfo
     for line in input:
@@ -2884,6 +4355,10 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
             elif re.search('key="828"', line):
                 options.moduleNamespace = m.group(3)
                 options.modulePrefix = options.moduleNamespace + ':'
+            ### MODIFIED_START - image/file references of pages
+            elif re.search('key="6"', line):
+                options.imageNamespaces.add(m.group(3).lower())
+            ### MODIFIED_END
         elif tag == '/siteinfo':
             break
 
@@ -2893,21 +4368,43 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
         if template_file:
             if os.path.exists(template_file):
                 logging.info("Loading template definitions from: %s", template_file)
-                # can't use with here:
-                file = fileinput.FileInput(template_file,
-                                           openhook=fileinput.hook_compressed)
-                load_templates(file)
-                file.close()
+                ### MODIFIED_START - template store
+                load_template_store(template_file)
+                ### MODIFIED_END
             else:
                 if input_file == '-':
                     # can't scan then reset stdin; must error w/ suggestion to specify template_file
                     raise ValueError("to use templates with stdin dump, must supply explicit template-file")
                 logging.info("Preprocessing '%s' to collect template definitions: this may take some time.", input_file)
+                ### MODIFIED_START - parallel bz2 decompression, multistream index
+                if index_file:
+                    input.close()
+                    input = open_dump(input_file, decompress_count)
                 load_templates(input, template_file)
                 input.close()
-                input = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
+                if not index_file:
+                    input = open_dump(input_file, decompress_count)
+                ### MODIFIED_END
+                ### MODIFIED_START - shared parsed templates
+                # the extract processes share the parsed templates in a store for this run only:
+                # templates read from the dump differ from the ones read from template_file
+                # (whitespace), which is what the store of template_file has (see load_template_store())
+                fd, run_store_file = tempfile.mkstemp(suffix=storeSuffix)
+                os.close(fd)
+                runStoreFiles.append(run_store_file)
+                try:
+                    TemplateStore.write(run_store_file, template_file)
+                except (IOError, OSError) as e:
+                    logging.warn("Could not save template store: %s", e)
+                else:
+                    options.templateCache = TemplateStore.open(run_store_file, template_file)
+                    options.templates = {}
+                ### MODIFIED_END
         template_load_elapsed = default_timer() - template_load_start
-        logging.info("Loaded %d templates in %.1fs", len(options.templates), template_load_elapsed)
+        ### MODIFIED_START - template store
+        logging.info("Loaded %d templates in %.1fs", len(options.templates) + len(options.templateCache),
+                     template_load_elapsed)
+        ### MODIFIED_END
 
     # process pages
     logging.info("Starting page extraction from %s.", input_file)
@@ -2940,21 +4437,68 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
     # initialize jobs queue
     jobs_queue = Queue(maxsize=maxsize)
 
+    ### MODIFIED_START - multistream index
+    # number of extracted pages, counted by the workers reading streams
+    page_count = Value('i', 0)
+    ### MODIFIED_END
+    ### MODIFIED_START - page filter chain
+    page_filter = pageFilter()
+    # stats of page filters of the workers reading streams
+    filter_stats_queue = Queue()
+    ### MODIFIED_END
+
+    ### MODIFIED_START - shared parsed templates
+    if hasattr(gc, 'freeze'):
+        # objects of this process (e.g. templates not in a store) are not touched
+        # (and so copied) by garbage collections of the extract processes
+        gc.freeze()
+    ### MODIFIED_END
+
     # start worker processes
     logging.info("Using %d extract processes.", worker_count)
     workers = []
     for i in range(worker_count):
-        extractor = Process(target=extract_process,
-                            args=(options, i, jobs_queue, output_queue))
+        ### MODIFIED_START - multistream index
+        if index_file:
+            extractor = Process(target=extract_streams_process,
+                                args=(options, i, input_file, jobs_queue, output_queue, page_count,
+                                      filter_stats_queue))
+        else:
+            extractor = Process(target=extract_process,
+                                args=(options, i, jobs_queue, output_queue))
+        ### MODIFIED_END
         extractor.daemon = True  # only live while parent process lives
         extractor.start()
         workers.append(extractor)
 
+    ### MODIFIED_START - multistream index
+    if index_file:
+        # no mapper: workers get stream ranges, results are ordered by stream
+        logging.info("Reading %d streams of %s.", len(streams), input_file)
+        # spool holds whole streams (about 100 pages each)
+        max_spool_length //= 100
+        for stream_num, (offset, length) in enumerate(streams):
+            delay = 0
+            if spool_length.value > max_spool_length:
+                while spool_length.value > max_spool_length/10:
+                    time.sleep(1)
+                    delay += 1
+            if delay:
+                logging.info('Delay %ds', delay)
+            jobs_queue.put((stream_num, offset, length))
+        input.close()
+        input = []              # nothing to map
+    ### MODIFIED_END
+
     # Mapper process
     page_num = 0
-    for page_data in pages_from(input):
+    ### MODIFIED_START - reader filters
+    for page_data in pages_from(input, articleKeys, options.skipTitle, page_filter.stats):
+    ### MODIFIED_END
         id, revid, title, ns, page = page_data
-        if keepPage(ns, page):
+        ### MODIFIED_START - page filter chain
+        if page_filter.keep(ns, title, page):
+        ### MODIFIED_END
             # slow down
             delay = 0
             if spool_length.value > max_spool_length:
@@ -2969,11 +4513,19 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
             page_num += 1
         page = None             # free memory
 
-    input.close()
+    ### MODIFIED_START - multistream index
+    if not index_file:
+        input.close()
+    ### MODIFIED_END
 
     # signal termination
     for _ in workers:
         jobs_queue.put(None)
+    ### MODIFIED_START - page filter chain
+    if index_file:
+        for _ in workers:
+            page_filter.merge(filter_stats_queue.get())
+    ### MODIFIED_END
     # wait for workers to terminate
     for w in workers:
         w.join()
@@ -2983,10 +4535,17 @@ def process_dump(input_file, template_file, out_file, file_size, file_compress,
     # wait for it to finish
     reduce.join()
 
+    ### MODIFIED_START - multistream index
+    if index_file:
+        page_num = page_count.value
+    ### MODIFIED_END
     extract_duration = default_timer() - extract_start
     extract_rate = page_num / extract_duration
     logging.info("Finished %d-process extraction of %d articles in %.1fs (%.1f art/s)",
                  process_count, page_num, extract_duration, extract_rate)
+    ### MODIFIED_START - page filter chain
+    page_filter.report()
+    ### MODIFIED_END
 
 
 # ----------------------------------------------------------------------
@@ -3012,22 +4571,104 @@ def extract_process(opts, i, jobs_queue, output_queue):
         job = jobs_queue.get()  # job is (id, title, page, page_num)
         if job:
             id, revid, title, page, page_num = job
-            try:
-                e = Extractor(*job[:4]) # (id, revid, title, page)
-                page = None              # free memory
-                e.extract(out)
-                text = out.getvalue()
-            except:
-                text = ''
-                logging.exception('Processing page: %s %s', id, title)
-
-            output_queue.put((page_num, text))
-            out.truncate(0)
-            out.seek(0)
+            ### MODIFIED_START - multistream index
+            text, images = extract_page(out, id, revid, title, page)
+            page = None              # free memory
+            output_queue.put((page_num, [(text, images)]))
+            ### MODIFIED_END
         else:
             logging.debug('Quit extractor')
             break
     out.close()
+    ### MODIFIED_START - template expansion cache
+    if options.expansionCache is not None:
+        options.expansionCache.report(i)
+    ### MODIFIED_END
+    ### MODIFIED_START - template profiler
+    if options.templateProfile is not None:
+        output_queue.put((None, options.templateProfile))
+    ### MODIFIED_END
+
+
+### MODIFIED_START - multistream index
+def extract_page(out, id, revid, title, page):
+    """
+    :param out: memory buffer.
+    :return: (text, images line) of the page, '' if it can not be extracted.
+    """
+    images = ''
+    try:
+        e = Extractor(id, revid, title, page)
+        ### MODIFIED_START - template profiler
+        profile = options.templateProfile
+        if profile is not None:
+            profile.startPage()
+        e.extract(out)
+        if profile is not None:
+            profile.endPage(id, title)
+        ### MODIFIED_END
+        text = out.getvalue()
+        if options.images_file and text:
+            images = '%s\t%s\n' % (id, '|'.join(e.images))
+    except:
+        text = ''
+        logging.exception('Processing page: %s %s', id, title)
+    out.truncate(0)
+    out.seek(0)
+    return text, images
+
+
+def extract_streams_process(opts, i, input_file, jobs_queue, output_queue, page_count, filter_stats_queue):
+    """Read streams of a multistream dump, extract their pages, push finished texts of each stream
+    :param i: process id.
+    :param input_file: the multistream dump.
+    :param jobs_queue: where to get jobs (stream_num, offset, length).
+    :param output_queue: where to queue extracted texts for output.
+    :param page_count: number of extracted pages (shared).
+    :param filter_stats_queue: where to put stats of the page filter at the end.
+    """
+
+    global options
+    options = opts
+
+    createLogger(options.quiet, options.debug)
+
+    out = StringIO()                 # memory buffer
+    input = open(input_file, 'rb')
+    page_filter = pageFilter()
+
+    while True:
+        job = jobs_queue.get()
+        if not job:
+            logging.debug('Quit extractor')
+            break
+        stream_num, offset, length = job
+        pages = []
+        try:
+            input.seek(offset)
+            lines = BytesIO(decompress_streams(input.read(length)))
+        except:
+            lines = []
+            logging.exception('Reading stream at offset %d', offset)
+        for id, revid, title, ns, page in pages_from(lines, articleKeys, options.skipTitle, page_filter.stats):
+            if page_filter.keep(ns, title, page):
+                pages.append(extract_page(out, id, revid, title, page))
+            page = None              # free memory
+        with page_count.get_lock():
+            page_count.value += len(pages)
+        output_queue.put((stream_num, pages))
+    filter_stats_queue.put(page_filter.stats)
+    input.close()
+    out.close()
+    ### MODIFIED_START - template expansion cache
+    if options.expansionCache is not None:
+        options.expansionCache.report(i)
+    ### MODIFIED_END
+    ### MODIFIED_START - template profiler
+    if options.templateProfile is not None:
+        output_queue.put((None, options.templateProfile))
+    ### MODIFIED_END
+### MODIFIED_END
 
 
 report_period = 10000           # progress report period
@@ -3046,6 +4687,13 @@ def reduce_process(opts, output_queue, spool_length,
     options = opts
     
     createLogger(options.quiet, options.debug)
+
+    ### MODIFIED_START - image/file references of pages
+    # lines "page id<tab>image paths separated by |", in the order of the pages
+    images_output = None
+    if options.images_file:
+        images_output = codecs.open(options.images_file, 'w', 'utf-8')
+    ### MODIFIED_END
     
     if out_file:
         nextFile = NextFile(out_file)
@@ -3059,25 +4707,41 @@ def reduce_process(opts, output_queue, spool_length,
     # FIXME: use a heap
     spool = {}        # collected pages
     next_page = 0     # sequence numbering of page
+    ### MODIFIED_START - multistream index
+    # a job is a page, or a stream of pages with --multistream_index
+    article_count = 0
+    ### MODIFIED_END
     while True:
         if next_page in spool:
-            output.write(spool.pop(next_page).encode('utf-8'))
+            ### MODIFIED_START - multistream index
+            for text, images in spool.pop(next_page):
+                output.write(text.encode('utf-8'))
+                if images_output:
+                    images_output.write(images)
+                article_count += 1
+                # progress report
+                if article_count % report_period == 0:
+                    interval_rate = report_period / (default_timer() - interval_start)
+                    logging.info("Extracted %d articles (%.1f art/s)",
+                                 article_count, interval_rate)
+                    interval_start = default_timer()
+            ### MODIFIED_END
             next_page += 1
             # tell mapper our load:
             spool_length.value = len(spool)
-            # progress report
-            if next_page % report_period == 0:
-                interval_rate = report_period / (default_timer() - interval_start)
-                logging.info("Extracted %d articles (%.1f art/s)",
-                             next_page, interval_rate)
-                interval_start = default_timer()
         else:
             # mapper puts None to signal finish
             pair = output_queue.get()
             if not pair:
                 break
-            page_num, text = pair
-            spool[page_num] = text
+            ### MODIFIED_START - multistream index, template profiler
+            page_num, pages = pair
+            if page_num is None:
+                # profile of an extract process, at its end
+                options.templateProfile.merge(pages)
+                continue
+            spool[page_num] = pages
+            ### MODIFIED_END
             # tell mapper our load:
             spool_length.value = len(spool)
             # FIXME: if an extractor dies, process stalls; the other processes
@@ -3087,6 +4751,12 @@ def reduce_process(opts, output_queue, spool_length,
                               next_page, next_page == page_num)
     if output != sys.stdout:
         output.close()
+    if images_output:
+        images_output.close()
+    ### MODIFIED_START - template profiler
+    if options.templateProfile is not None:
+        options.templateProfile.write(options.templateProfileFile)
+    ### MODIFIED_END
 
 
 # ----------------------------------------------------------------------
@@ -3111,6 +4781,9 @@ def main():
                         help="compress output files using bzip")
     groupO.add_argument("--json", action="store_true",
                         help="write output in json format instead of the default one")
+    groupO.add_argument("--images", metavar="FILE",
+                        help="write image/file references of each page into FILE: page id, tab and "
+                             "wikimedia/commons/... paths separated by |")
 
 
     groupP = parser.add_argument_group('Processing')
@@ -3140,9 +4813,25 @@ def main():
                         help="comma separated list of elements that will be removed from the article text")
     groupP.add_argument("--keep_tables", action="store_true", default=options.keep_tables,
                         help="Preserve tables in the output article text (default=%(default)s)")
+    ### MODIFIED_START - reader filters
+    groupP.add_argument("--skip_titles", metavar="REGEX",
+                        help="skip pages whose titles match REGEX (e.g. '^Seznam'), without reading their text")
+    ### MODIFIED_END
+    ### MODIFIED_START - template expansion cache
+    groupP.add_argument("--expansion_cache", type=int, default=10000, metavar="N",
+                        help="cache N template expansions in each process (default %(default)s, 0: no cache)")
+    ### MODIFIED_END
     default_process_count = max(1, cpu_count() - 1)
     parser.add_argument("--processes", type=int, default=default_process_count,
                         help="Number of processes to use (default %(default)s)")
+    ### MODIFIED_START - parallel bz2 decompression, multistream index
+    parser.add_argument("--multistream_index", metavar="FILE",
+                        help="index of a multistream dump (pages-articles-multistream-index.txt.bz2): "
+                             "the extract processes read and decompress streams of the dump themselves")
+    parser.add_argument("--decompress_processes", type=int, default=0,
+                        help="Number of processes decompressing a .bz2 dump, splitting it at bz2 streams "
+                             "(for multistream dumps; default %(default)s: sequentially in the reading process)")
+    ### MODIFIED_END
 
     groupS = parser.add_argument_group('Special')
     groupS.add_argument("-q", "--quiet", action="store_true",
@@ -3151,6 +4840,11 @@ def main():
                         help="print debug info")
     groupS.add_argument("-a", "--article", action="store_true",
                         help="analyze a file containing a single article (debug option)")
+    ### MODIFIED_START - template profiler
+    groupS.add_argument("--profile_templates", metavar="FILE",
+                        help="profile expansions of templates and parser functions in all processes, "
+                             "write calls, times and depths, the largest expansions and the slowest pages to FILE")
+    ### MODIFIED_END
     groupS.add_argument("-v", "--version", action="version",
                         version='%(prog)s ' + version,
                         help="print program version")
@@ -3164,6 +4858,20 @@ def main():
     options.write_json = args.json
     options.print_revision = args.revision
     options.min_text_length = args.min_text_length
+    options.images_file = args.images
+    ### MODIFIED_START - reader filters
+    if args.skip_titles:
+        options.skipTitle = re.compile(args.skip_titles)
+    ### MODIFIED_END
+    ### MODIFIED_START - template expansion cache
+    if args.expansion_cache > 0:
+        options.expansionCache = ExpansionCache(args.expansion_cache)
+    ### MODIFIED_END
+    ### MODIFIED_START - template profiler
+    if args.profile_templates:
+        options.templateProfile = TemplateProfile()
+        options.templateProfileFile = args.profile_templates
+    ### MODIFIED_END
     if args.html:
         options.keepLinks = True
 
@@ -3217,18 +4925,32 @@ def main():
     # sharing cache of parser templates is too slow:
     # manager = Manager()
     # templateCache = manager.dict()
+    ### MODIFIED_START - shared parsed templates
+    # templates are parsed once into a store mapped by the extract processes instead (see TemplateStore)
+    ### MODIFIED_END
 
     if args.article:
         if args.templates:
             if os.path.exists(args.templates):
-                with open(args.templates) as file:
-                    load_templates(file)
+                ### MODIFIED_START - template store
+                load_template_store(args.templates)
+                ### MODIFIED_END
 
         file = fileinput.FileInput(input_file, openhook=fileinput.hook_compressed)
         for page_data in pages_from(file):
             id, revid, title, ns, page = page_data
+            ### MODIFIED_START - template profiler
+            if options.templateProfile is not None:
+                options.templateProfile.startPage()
             Extractor(id, revid, title, page).extract(sys.stdout)
+            if options.templateProfile is not None:
+                options.templateProfile.endPage(id, title)
+            ### MODIFIED_END
         file.close()
+        ### MODIFIED_START - template profiler
+        if options.templateProfile is not None:
+            options.templateProfile.write(options.templateProfileFile)
+        ### MODIFIED_END
         return
 
     output_path = args.output
@@ -3240,7 +4962,8 @@ def main():
             return
 
     process_dump(input_file, args.templates, output_path, file_size,
-                 args.compress, args.processes)
+                 args.compress, args.processes, args.decompress_processes,
+                 args.multistream_index)
 
 def createLogger(quiet, debug):
     logger = logging.getLogger()
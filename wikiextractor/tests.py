@@ -4,11 +4,22 @@ from __future__ import unicode_literals
 
 import sys
 import os.path
+import gc
+import re
+import bz2
+import tempfile
 import unittest
+import weakref
+from io import BytesIO
+from timeit import default_timer
 
 from WikiExtractor import (
     normalizeTitle, unescape, ucfirst, lcfirst, splitParts,
-    fullyQualifiedTemplateTitle, NextFile
+    fullyQualifiedTemplateTitle, NextFile, findImageParams, findImageLinks, imagePath,
+    ParallelBZ2Reader, last_stream_start, read_multistream_index, pages_from,
+    PageFilter, namespaceRule, unwantedRule, options, TemplateArg, TemplateStore,
+    Extractor, ExpansionCache, Template, DelimiterIndex, findMatchingBraces, findBalanced,
+    callParserFunction, TemplateProfile, ignoreTag, dropElements, dropElementsByTag
 )
 
 
@@ -96,5 +107,401 @@ class TestNextFile(unittest.TestCase):
         self.assertEqual(next(f), 'out{}AB/wiki_00'.format(os.path.sep))
 
 
+class TestImages(unittest.TestCase):
+
+    def test_image_path(self):
+        self.assertEqual(imagePath('Example.jpg'), 'wikimedia/commons/a/a9/Example.jpg')
+        self.assertEqual(imagePath('File: example.jpg'), 'wikimedia/commons/a/a9/Example.jpg')
+        self.assertEqual(imagePath('Tom &amp;amp; Jerry.png'), 'wikimedia/commons/9/96/Tom_%26_Jerry.png')
+
+    def test_find_images(self):
+        self.assertEqual(findImageParams('{{Infobox|name=X|image = Praha.jpg|caption=Praha.jpg view}}'),
+                         ['Praha.jpg'])
+        self.assertEqual(findImageParams('{{Infobox|obrázek=http://example.org/a/b.jpg|mapa=Mapa.svg}}'),
+                         ['Mapa.svg'])
+        self.assertEqual(findImageLinks('[[File:A.png|thumb|a [[b]] c]] [[:Image:B.pdf]] [[File:{{{1}}}.svg]] [[C.jpg]]'),
+                         ['A.png', 'B.pdf'])
+        self.assertEqual(findImageLinks('&lt;gallery mode="packed"&gt;\nFile:G1.jpg|one\nG2.jpeg\n&lt;/gallery&gt;'),
+                         ['File:G1.jpg', 'G2.jpeg'])
+
+
+class TestPagesFrom(unittest.TestCase):
+
+    dump = """<mediawiki>
+  <page>
+    <title>Praha &amp; okolí</title>
+    <ns>0</ns>
+    <id>1</id>
+    <revision>
+      <id>11</id>
+      <text xml:space="preserve">'''Praha''' &lt;ref&gt;x&lt;/ref&gt;
+== Dějiny ==
+text</text>
+    </revision>
+  </page>
+  <page>
+    <title>Přesměrování</title>
+    <ns>0</ns>
+    <id>2</id>
+    <redirect title="Praha" />
+    <revision>
+      <id>12</id>
+      <text xml:space="preserve">#REDIRECT [[Praha]]</text>
+    </revision>
+  </page>
+  <page>
+    <title>Šablona:Prázdná</title>
+    <ns>10</ns>
+    <id>3</id>
+    <revision>
+      <id>13</id>
+      <text xml:space="preserve" />
+    </revision>
+  </page>
+</mediawiki>
+"""
+
+    pages = [('1', '11', 'Praha &amp; okolí', '0', ["'''Praha''' &lt;ref&gt;x&lt;/ref&gt;\n== Dějiny ==\ntext"]),
+             ('3', '13', 'Šablona:Prázdná', '10', [''])]
+
+    def test_lines(self):
+        self.assertEqual(list(pages_from(self.dump.splitlines(True))), self.pages)
+        self.assertEqual(list(pages_from(self.dump.encode('utf-8').splitlines(True))), self.pages)
+
+    def test_chunks(self):
+        # tags and text split between chunks
+        for size in (1, 5, 100):
+            class Reader(BytesIO):
+                def read(self, n=-1):
+                    return BytesIO.read(self, size)
+            self.assertEqual(list(pages_from(Reader(self.dump.encode('utf-8')))), self.pages)
+
+    def test_filters(self):
+        self.assertEqual(list(pages_from(self.dump.splitlines(True), set(['0']))), self.pages[:1])
+        self.assertEqual(list(pages_from(self.dump.splitlines(True), None, re.compile('^Praha'))), self.pages[1:])
+        self.assertEqual(list(pages_from(self.dump.splitlines(True), set(['10']), re.compile('Prázdná'))), [])
+
+
+class TestPageFilter(unittest.TestCase):
+
+    def test_unwanted(self):
+        self.assertTrue(unwantedRule('0', 'A', '{{Rozcestník}}\ntext'))
+        self.assertTrue(unwantedRule('0', 'A', 'text\n{{Seznam|x}} {{Seznam}}'))
+        self.assertFalse(unwantedRule('0', 'A', 'text {{Seznam}}'))
+        self.assertFalse(unwantedRule('0', 'A', '{{Seznam\n}}'))
+
+    def test_chain(self):
+        f = PageFilter([('namespace', namespaceRule), ('unwanted', unwantedRule)])
+        self.assertTrue(f.keep('0', 'A', ['text']))
+        self.assertFalse(f.keep('10', 'A', ['text']))
+        self.assertFalse(f.keep('0', 'A', ['{{Rozcestník}}']))
+        self.assertEqual([f.stats['namespace'][0], f.stats['unwanted'][0]], [1, 1])
+        f.merge({'namespace': [2, 0.5], 'unwanted': [0, 0.0]})
+        self.assertEqual(f.stats['namespace'][0], 3)
+
+
+class TestTemplateStore(unittest.TestCase):
+
+    def test_store(self):
+        source = tempfile.mktemp()
+        path = tempfile.mktemp()
+        with open(source, 'wb') as f:
+            f.write(b'<page></page>')
+        templates = options.templates
+        options.templates = {'Šablona:A': 'a {{{1|{{{b|x}}}}}} {{B}}', 'Šablona:B': 'b'}
+        try:
+            TemplateStore.write(path, source)
+            store = TemplateStore.open(path, source)
+            self.assertEqual(len(store), 2)
+            self.assertTrue('Šablona:B' in store)
+            self.assertFalse('Šablona:C' in store)
+            template = store['Šablona:A']
+            self.assertEqual(str(template), options.templates['Šablona:A'])
+            self.assertTrue(isinstance(template[1], TemplateArg))
+            self.assertEqual(str(template[1].default), '{{{b|x}}}')
+            self.assertTrue(store['Šablona:A'] is template)
+            version = TemplateStore.version
+            TemplateStore.version += 1
+            try:
+                self.assertEqual(TemplateStore.open(path, source), None)
+            finally:
+                TemplateStore.version = version
+            with open(source, 'ab') as f:
+                f.write(b'\n')
+            self.assertEqual(TemplateStore.open(path, source), None)
+        finally:
+            options.templates = templates
+            os.remove(source)
+            os.remove(path)
+
+
+class TestExpansionCache(unittest.TestCase):
+
+    def test_lru(self):
+        cache = ExpansionCache(2)
+        cache.put('a', 'A')
+        cache.put('b', 'B')
+        self.assertEqual(cache.get('a'), 'A')
+        cache.put('c', 'C')
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('a'), 'A')
+        self.assertEqual([cache.hits, cache.misses, cache.evictions], [2, 1, 1])
+
+    def test_expand(self):
+        saved = options.templates, options.templateCache, options.expansionCache, options.templatePrefix
+        options.templates = {'Template:A': 'a{{{1}}}', 'Template:P': '{{PAGENAME}}{{{1}}}'}
+        options.templateCache = {}
+        options.templatePrefix = 'Template:'
+        options.expansionCache = cache = ExpansionCache(10)
+        try:
+            for title in ('X', 'Y'):
+                e = Extractor('1', '1', title, [])
+                e.magicWords['PAGENAME'] = title
+                self.assertEqual(e.expand('{{A|1}} {{A|1}} {{A|2}} {{P|1}}'), 'a1 a1 a2 %s1' % title)
+            self.assertEqual([cache.hits, cache.misses, cache.uncached], [4, 4, 2])
+        finally:
+            options.templates, options.templateCache, options.expansionCache, options.templatePrefix = saved
+
+
+class TestTemplateProfile(unittest.TestCase):
+
+    def test_expand(self):
+        saved = options.templates, options.templateCache, options.templateProfile, options.templatePrefix
+        options.templates = {'Template:A': '{{#if:{{{1}}}|{{B|{{{1}}}}}}}', 'Template:B': 'b{{{1}}}'}
+        options.templateCache = {}
+        options.templatePrefix = 'Template:'
+        options.templateProfile = profile = TemplateProfile()
+        try:
+            e = Extractor('1', '1', 'X', [])
+            profile.startPage()
+            self.assertEqual(e.expand('{{A|1}} {{A|}} {{A|22}}'), 'b1  b22')
+            profile.endPage('1', 'X')
+            calls = dict((title, stats[0]) for title, stats in profile.templates.items())
+            self.assertEqual(calls, {'Template:A': 3, 'Template:B': 2, '#if': 3})
+            calls, hits, cumulative, own, depth = profile.templates['Template:A']
+            self.assertTrue(0 <= own <= cumulative)
+            self.assertEqual([depth, profile.templates['Template:B'][4]], [0, 1])
+            self.assertEqual(sorted(profile.largest)[-2:], [(3, 'Template:A', 'X'), (3, 'Template:B', 'X')])
+            self.assertEqual([page[1:] for page in profile.slowest], [('1', 'X')])
+        finally:
+            options.templates, options.templateCache, options.templateProfile, options.templatePrefix = saved
+
+    def test_merge(self):
+        profiles = [TemplateProfile(), TemplateProfile()]
+        for i, profile in enumerate(profiles):
+            profile.templates['Template:A'] = [2, 1, 0.5, 0.25, i]
+            profile.largest.append((i, 'Template:A', 'Page %d' % i))
+            profile.slowest.append((0.5 * i, str(i), 'Page %d' % i))
+        profiles[0].merge(profiles[1])
+        self.assertEqual(profiles[0].templates, {'Template:A': [4, 2, 1.0, 0.5, 1]})
+        path = tempfile.mktemp()
+        try:
+            profiles[0].write(path)
+            with open(path, 'rb') as f:
+                lines = f.read().decode('utf-8').split('\n')
+            self.assertEqual(lines[1], 'Template:A\t4\t2\t1.000\t0.500\t1')
+            self.assertEqual(lines[4:6], ['1\tTemplate:A\tPage 1', '0\tTemplate:A\tPage 0'])
+            self.assertEqual(lines[8:10], ['0.500\t1\tPage 1', '0.000\t0\tPage 0'])
+        finally:
+            os.remove(path)
+
+
+class TestCompiledTemplate(unittest.TestCase):
+
+    templates = ["{{#if:{{{obyvatel|}}}|{{Řádek|Počet obyvatel|{{{obyvatel}}}}}}}\n|}",
+                 "{{{příjmení|}}}{{#if:{{{jméno|}}}|, {{{jméno}}}}}. ''{{{titul|{{PAGENAME}}}}}''",
+                 "[[Soubor:{{{obrázek|Blank.png}}}|200px]] {{{{{1|}}}}} {{x|{{{1}}}|{{{2}}}}}",
+                 "<nowiki>{{{1}}}</nowiki> {{x|{{{2}}}}}"]
+
+    params = [{}, {'obyvatel': '1000', 'jméno': 'Jan', '1': '', '2': 'a|b'},
+              {'obyvatel': '[[Praha]]', 'obrázek': '[[x]]', '1': '{', '2': '<nowiki>'},
+              {'titul': '[[A|B]]', '1': 'Řádek', '2': '[[Praha]]'}]
+
+    def test_expand(self):
+        saved = options.templates, options.templateCache, options.templatePrefix
+        options.templates = {'Template:Řádek': '{{!}} {{{1}}} {{!}} {{{2}}}', 'Template:X': '({{{1}}}/{{{2|}}})'}
+        options.templateCache = {}
+        options.templatePrefix = 'Template:'
+        try:
+            for text in self.templates:
+                for params in self.params:
+                    e = Extractor('1', '1', 'Praha', [])
+                    e.magicWords['PAGENAME'] = 'Praha'
+                    expected = e.transform(Template.parse(text).subst(params, e))
+                    self.assertEqual(Template.parse(text).expand(params, e), expected)
+        finally:
+            options.templates, options.templateCache, options.templatePrefix = saved
+
+
+class TestDelimiterIndex(unittest.TestCase):
+
+    text = "{{{{x}}}} {{a|[[b|{{c}}]]|d}}} [[[e]]] ]]{{f|{{{g|h}}}}}[[i"
+
+    def test_window(self):
+        index = DelimiterIndex(self.text)
+        for begin in range(len(self.text) + 1):
+            for end in range(begin, len(self.text) + 1):
+                self.assertEqual(index.window(begin, end).runs, DelimiterIndex(self.text[begin:end]).runs)
+
+    def test_matching(self):
+        self.assertEqual(list(findMatchingBraces(self.text)), [(0, 9), (10, 29), (31, 38), (41, 56)])
+        self.assertEqual(list(findMatchingBraces(self.text, 2)), [(0, 9), (10, 29), (41, 56)])
+        self.assertEqual(list(findMatchingBraces(self.text, 3)), [(0, 9), (45, 54)])
+        self.assertEqual(list(findBalanced(self.text)), [(14, 25), (31, 37)])
+        self.assertEqual(splitParts(self.text), ['{{{{x}}}} {{a|[[b|{{c}}]]|d}}} [[[e]]] ]]{{f|{{{g|h}}}}}[[i'])
+        self.assertEqual(splitParts('a|{{b|c}}|[[d|e]]{{f}}g|'), ['a', '{{b|c}}', '[[d|e]]{{f}}g', ''])
+
+    @staticmethod
+    def infobox(depth, width):
+        """Infoboxes nested depth times, each with width templates in a parameter."""
+        prefix = '{{Infobox\n|obrázek=[[Soubor:A.png|200px|[[B]]]]\n|obsah='
+        suffix = '\n|pozn=%s}}\n' % ('{{{1|}}}, {{Ref|[[C]]}}' * width)
+        return prefix * depth + 'x' + suffix * depth
+
+    def elapsed(self, text):
+        best = None
+        for _ in range(3):
+            start = default_timer()
+            list(findMatchingBraces(text))
+            splitParts(text[2:-3])
+            list(findBalanced(text))
+            elapsed = default_timer() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    def test_linear(self):
+        # deeply nested and wide infoboxes: 16 times longer text must not take
+        # much more than 16 times longer
+        self.assertEqual(len(list(findMatchingBraces(self.infobox(4000, 1)))), 1)
+        self.assertEqual(len(splitParts(self.infobox(1, 32000)[2:-3])), 4)
+        for small, large in (((250, 1), (4000, 1)), ((1, 2000), (1, 32000))):
+            ratio = self.elapsed(self.infobox(*large)) / self.elapsed(self.infobox(*small))
+            self.assertLess(ratio, 16 * 2.5)
+
+
+class TestDropElements(unittest.TestCase):
+
+    def setUp(self):
+        self.ignored = list(options.ignored_tag_patterns)
+        ignoreTag('b')
+        ignoreTag('span')
+
+    def tearDown(self):
+        options.ignored_tag_patterns[:] = self.ignored
+
+    def test_drop(self):
+        for text, dropped in (
+                ('Praha<ref name="a">x<ref>y</ref></ref> je <b>hlavní</b> město<!-- <ref> -->.',
+                 'Praha je hlavní město.'),
+                ('<div style="x"><span>a</span><small>b</small></div>c<ref>d</ref><!--e--><ref>f</ref>g', 'cg'),
+                ('<ref>a<ref>b</ref>c', 'c'),
+                ('a</ref>b<sup>1</sup><br/>c', 'a</ref>bc'),
+                # joined by dropping the comment
+                ('<ta<!-- -->ble>x</table>y', 'y')):
+            self.assertEqual(dropElements(text), dropped)
+            self.assertEqual(dropElementsByTag(text), dropped)
+
+    def test_long(self):
+        article = ''.join('Obec<ref>[[Soubor:A.png]]<!-- %d --></ref> má <span>%d</span> obyvatel<sup>[%d]</sup>.\n'
+                          '<div><small>a</small><div>b</div></div><references/>\n' % (i, i, i)
+                          for i in range(1000))
+        self.assertEqual(dropElements(article), dropElementsByTag(article))
+        self.assertEqual(dropElements(article), ''.join('Obec má %d obyvatel.\n\n' % i for i in range(1000)))
+
+
+class TestExpr(unittest.TestCase):
+
+    def expr(self, expr, *args):
+        e = Extractor('1', '1', 'Praha', [])
+        return callParserFunction('#ifexpr' if args else '#expr', [expr] + list(args), e)
+
+    def test_expr(self):
+        for expr, value in (('1 + 1', '2'), ('30/7', '4.2857142857143'), ('2^3^2', '64'), ('-2^2', '4'),
+                            ('(1 + 2) * 3', '9'), ('1e3', '1000'), ('1e15', '1.0E+15'), ('0.00001', '1.0E-5'),
+                            ('-1.5 round 0', '-2'), ('1.955 round 2', '1.96'), ('-12 mod 5', '-2'),
+                            ('7 div 2', '3.5'), ('pi', '3.1415926535898'), ('2 &lt; 3 and not 0', '1'),
+                            ('2024 − 1958', '66'), ('10^400', 'INF'), ('trunc -1.9', '-1'), ('', ''),
+                            ('1e400 fmod 2', 'NAN'), ('-7 fmod 1e400', '-7')):
+            self.assertEqual(self.expr(expr), value)
+
+    def test_errors(self):
+        for expr, error in (('1/0', 'Division by zero.'),
+                            ('1 +', 'Expression error: Missing operand for +.'),
+                            ('(1', 'Expression error: Unclosed bracket.'),
+                            ('1)', 'Expression error: Unexpected closing bracket.'),
+                            ('1 2', 'Expression error: Unexpected number.'),
+                            ('__import__', 'Expression error: Unrecognized punctuation character "_".'),
+                            ('x', 'Expression error: Unrecognized word "x".'),
+                            ('negative 3', 'Expression error: Unrecognized word "negative".'),
+                            ('-', 'Expression error: Missing operand for -.'),
+                            ('(' * 101 + '1' + ')' * 101, 'Expression error: Stack exhausted.')):
+            self.assertEqual(self.expr(expr), '<strong class="error">%s</strong>' % error)
+
+    def test_error_pages(self):
+        # the cached error of an invalid expression keeps no extractor alive
+        extractors = []
+        for _ in range(10):
+            e = Extractor('1', '1', 'Praha', [])
+            self.assertEqual(callParserFunction('#expr', ['1 +'], e),
+                             '<strong class="error">Expression error: Missing operand for +.</strong>')
+            extractors.append(weakref.ref(e))
+        del e
+        gc.collect()
+        self.assertEqual([ref for ref in extractors if ref() is not None], [])
+
+    def test_ifexpr(self):
+        self.assertEqual(self.expr('1 < 2', ' a ', 'b'), 'a')
+        self.assertEqual(self.expr('1 > 2', 'a', ' b '), 'b')
+        self.assertEqual(self.expr('', 'a', 'b'), 'b')
+        self.assertEqual(self.expr('1 > 2', 'a'), '')
+        self.assertEqual(self.expr('x', 'a', 'b'), '<strong class="error">Expression error: Unrecognized word "x".</strong>')
+
+
+class TestParallelBZ2Reader(unittest.TestCase):
+
+    lines = [('<page>%d %s\n' % (i, 'text' * (i % 7))).encode('utf-8') for i in range(1000)]
+
+    def read(self, streams, chunk_size):
+        path = tempfile.mktemp(suffix='.bz2')
+        with open(path, 'wb') as f:
+            for stream in streams:
+                f.write(bz2.compress(stream))
+        reader = ParallelBZ2Reader(path, 2)
+        reader.chunk_size = chunk_size
+        try:
+            return list(reader)
+        finally:
+            reader.close()
+            os.remove(path)
+
+    def test_last_stream_start(self):
+        data = bz2.compress(b'a') + bz2.compress(b'b')
+        self.assertEqual(last_stream_start(data), len(bz2.compress(b'a')))
+        self.assertEqual(last_stream_start(bz2.compress(b'a')), -1)
+
+    def test_multistream(self):
+        # streams split inside lines
+        data = b''.join(self.lines)
+        streams = [data[i:i + 997] for i in range(0, len(data), 997)]
+        self.assertEqual(self.read(streams, 100), self.lines)
+        self.assertEqual(self.read(streams, 10000), self.lines)
+
+    def test_single_stream(self):
+        self.assertEqual(self.read([b''.join(self.lines)], 100), self.lines)
+
+    def test_multistream_index(self):
+        dump = tempfile.mktemp()
+        index = tempfile.mktemp(suffix='.bz2')
+        with open(dump, 'wb') as f:
+            f.write(b'x' * 1000)
+        with open(index, 'wb') as f:
+            f.write(bz2.compress(b'100:1:A\n100:2:B:C\n600:3:D\n'))
+        try:
+            self.assertEqual(read_multistream_index(index, dump), [(100, 500), (600, 400)])
+        finally:
+            os.remove(dump)
+            os.remove(index)
+
+
 if __name__ == '__main__':
     unittest.main()